@@ -1,6 +1,8 @@
-import sqlite3
+import asyncio
 import logging
 import os
+import tempfile
+import time
 from dotenv import load_dotenv
 
 # Загружаем переменные окружения
@@ -8,10 +10,21 @@ load_dotenv()
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler,
     ContextTypes, ConversationHandler, filters
 )
 
+import export
+import flood
+import maintenance
+import metrics
+import notifications
+import sessions
+import workers
+from search_cache import CachingStorage, SearchCache
+from storage import SQLiteStorage, create_storage
+from persistence import SQLitePersistence
+
 # Включаем логирование
 logging.basicConfig(
     level=logging.DEBUG,
@@ -34,63 +47,74 @@ logging.basicConfig(
     REPLACE_MATERIAL_SELECT_TOPIC,
     REPLACE_MATERIAL_SELECT_FILE,
     REPLACE_MATERIAL_NEW_FILE,
-    VIEW_TOPICS_SUBJECT
-) = range(15)
-
-# Подключение к БД
-def get_db_connection():
-    conn = sqlite3.connect('materials.db', check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-# Инициализация БД
-def init_db():
-    conn = get_db_connection()
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS subjects (
-            id INTEGER PRIMARY KEY,
-            name TEXT UNIQUE NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS topics (
-            id INTEGER PRIMARY KEY,
-            subject_id INTEGER NOT NULL,
-            name TEXT NOT NULL,
-            FOREIGN KEY (subject_id) REFERENCES subjects(id)
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS materials (
-            id INTEGER PRIMARY KEY,
-            topic_id INTEGER NOT NULL,
-            file_name TEXT NOT NULL,
-            telegram_file_id TEXT NOT NULL,
-            uploaded_by INTEGER,
-            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            downloads_count INTEGER DEFAULT 0,  -- ✅ Новое поле
-            FOREIGN KEY (topic_id) REFERENCES topics(id)
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS teachers (
-            user_id INTEGER PRIMARY KEY
-        )
-    """)
-    conn.commit()
-    conn.close()
+    VIEW_TOPICS_SUBJECT,
+    SUBSCRIBE_SUBJECT
+) = range(16)
+
+BOT_TOKEN = os.getenv("BOT_TOKEN", "ВСТАВЬ_ТОКЕН_ЗДЕСЬ")
+# Адрес Bot API; для проверки на одной машине можно указать локальную заглушку
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+DB_PATH = os.getenv("DB_PATH", "materials.db")
+PERSISTENCE_DB = os.getenv("PERSISTENCE_DB", "persistence.db")
+# Сколько процессов-обработчиков запускать (см. workers.py); 1 — обычный run_polling
+WORKERS = int(os.getenv("WORKERS", 1))
+
+# Бэкапы: куда, как часто (секунды) и сколько хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", 6 * 60 * 60))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7))
+# Как часто запускать ANALYZE/optimize/checkpoint/vacuum
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", 24 * 60 * 60))
+
+# Сколько секунд ждать ответа пользователя внутри диалога
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", 600))
+# Сессия без активности дольше SESSION_IDLE_TTL секунд удаляется из памяти
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", 1800))
+# Не больше MAX_SESSIONS сессий в памяти — сверх этого удаляются самые старые
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", 10000))
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", 300))
+
+# Защита от флуда: FLOOD_RATE запросов в секунду, до FLOOD_BURST подряд
+flood_limiter = flood.FloodLimiter(
+    rate=float(os.getenv("FLOOD_RATE", 1.0)),
+    capacity=int(os.getenv("FLOOD_BURST", 8)),
+    duplicate_window=float(os.getenv("FLOOD_DUPLICATE_WINDOW", 3.0)),
+    max_users=int(os.getenv("FLOOD_MAX_USERS", 50000))
+)
+
+# Хранилище: sqlite (по умолчанию) или memory — для бенчмарков и тестов
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+base_storage = create_storage(STORAGE_BACKEND, DB_PATH)
+# Кэш поиска: до SEARCH_CACHE_SIZE запросов, каждый живёт SEARCH_CACHE_TTL секунд;
+# результаты длиннее SEARCH_CACHE_MAX_ROWS строк не кэшируются
+storage = CachingStorage(base_storage, SearchCache(
+    max_entries=int(os.getenv("SEARCH_CACHE_SIZE", 1000)),
+    ttl=int(os.getenv("SEARCH_CACHE_TTL", 300)),
+    max_rows=int(os.getenv("SEARCH_CACHE_MAX_ROWS", 200))
+))
+
+# Сколько файлов одновременно скачивать при сборке архива
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 4))
+EXPORT_PREFIX = '📦 '
+EXPORT_ALL = '📦 Весь предмет'
+# Пользователи, для которых архив собирается прямо сейчас (не больше одного на человека)
+exporting_users = set()
+# Сколько архивов собирается одновременно на весь бот: при отправке PTB читает
+# файл архива в память целиком, так что это до EXPORT_MAX_PARALLEL * 50 МБ
+EXPORT_MAX_PARALLEL = int(os.getenv("EXPORT_MAX_PARALLEL", 2))
+export_slots = asyncio.Semaphore(EXPORT_MAX_PARALLEL)
 
 # Проверка, является ли пользователь преподавателем
 def is_teacher(user_id):
-    conn = get_db_connection()
-    cur = conn.execute('SELECT 1 FROM teachers WHERE user_id = ?', (user_id,))
-    res = cur.fetchone()
-    conn.close()
-    return res is not None
+    return storage.is_teacher(user_id)
+
+# Рассылка уведомлений подписчикам о новых материалах
+notifier = notifications.Notifier(storage.connect) if isinstance(base_storage, SQLiteStorage) else None
 
 # --- Обработчики ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()  # Начинаем с чистого листа
     user = update.effective_user
     if is_teacher(user.id):
         text = (
@@ -100,7 +124,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "🔍 Поиск по теме/предмету\n"
             "🗑 Удалить/заменить материал\n"
             "📋 Просмотр тем в предмете\n"
-            "📈 Статистика скачиваний"
+            "📈 Статистика скачиваний\n"
+            "🔔 Подписаться на новые материалы"
         )
         keyboard = [
             ['📚 Найти материал'],
@@ -108,19 +133,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ['🔍 Поиск по теме/предмету'],
             ['🗑 Удалить/заменить материал'],
             ['📋 Просмотр тем в предмете'],
-            ['📈 Статистика скачиваний']
+            ['📈 Статистика скачиваний'],
+            ['🔔 Подписки']
         ]
 
     else:
         text = (
             "Привет, студент! Здесь ты можешь:\n\n"
             "📚 Найти материал\n"
-            "🔍 Поиск по теме/предмету\n\n"
+            "🔍 Поиск по теме/предмету\n"
+            "🔔 Подписаться на новые материалы\n\n"
             "Если ты преподаватель — обратись к администратору бота."
         )
         keyboard = [
             ['📚 Найти материал'],
-            ['🔍 Поиск по теме/предмету']
+            ['🔍 Поиск по теме/предмету'],
+            ['🔔 Подписки']
         ]
     await update.message.reply_text(
         text,
@@ -129,6 +157,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает главное меню без приветствия"""
+    context.user_data.clear()  # Меню показывается в конце диалога — данные шагов больше не нужны
     user = update.effective_user
     if is_teacher(user.id):
         text = "Продолжим?"
@@ -138,14 +167,16 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ['🔍 Поиск по теме/предмету'],
             ['🗑 Удалить/заменить материал'],
             ['📋 Просмотр тем в предмете'],
-            ['📈 Статистика скачиваний']
+            ['📈 Статистика скачиваний'],
+            ['🔔 Подписки']
         ]
 
     else:
         text = "Продолжим?"
         keyboard = [
             ['📚 Найти материал'],
-            ['🔍 Поиск по теме/предмету']
+            ['🔍 Поиск по теме/предмету'],
+            ['🔔 Подписки']
         ]
     await update.message.reply_text(
         text,
@@ -159,18 +190,7 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Только преподаватели могут просматривать статистику.")
         return
 
-    conn = get_db_connection()
-    stats = conn.execute(
-        '''
-        SELECT m.file_name, m.downloads_count, t.name as topic_name, s.name as subject_name
-        FROM materials m
-        JOIN topics t ON m.topic_id = t.id
-        JOIN subjects s ON t.subject_id = s.id
-        ORDER BY m.downloads_count DESC
-        LIMIT 10
-        '''
-    ).fetchall()
-    conn.close()
+    stats = storage.top_downloads(10)
 
     if not stats:
         await update.message.reply_text("Нет данных по скачиваниям.")
@@ -191,19 +211,14 @@ async def add_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         user_id = int(context.args[0])
-        conn = get_db_connection()
-        conn.execute('INSERT OR IGNORE INTO teachers (user_id) VALUES (?)', (user_id,))
-        conn.commit()
-        conn.close()
+        storage.add_teacher(user_id)
         await update.message.reply_text(f"✅ Пользователь {user_id} теперь преподаватель.")
     except ValueError:
         await update.message.reply_text("Неверный ID.")
 
 # --- Студент: найти материал ---
 async def find_material(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = get_db_connection()
-    subjects = conn.execute('SELECT id, name FROM subjects').fetchall()
-    conn.close()
+    subjects = storage.list_subjects()
     if not subjects:
         await update.message.reply_text("Нет доступных предметов.")
         return ConversationHandler.END
@@ -216,75 +231,135 @@ async def find_material(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def select_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     subject_name = update.message.text.strip()
-    conn = get_db_connection()
-    subject = conn.execute('SELECT id FROM subjects WHERE name = ?', (subject_name,)).fetchone()
-    if not subject:
+    subject_id = storage.get_subject_id(subject_name)
+    if not subject_id:
         await update.message.reply_text("Предмет не найден.")
         return ConversationHandler.END
-    context.user_data['subject_id'] = subject['id']
-    topics = conn.execute('SELECT name FROM topics WHERE subject_id = ?', (subject['id'],)).fetchall()
-    conn.close()
+    context.user_data.subject_id = subject_id
+    topics = storage.list_topics(subject_id)
     if not topics:
         await update.message.reply_text("Нет тем по этому предмету.")
         return ConversationHandler.END
-    keyboard = [[t['name']] for t in topics]
+    # Рядом с каждой темой — кнопка «скачать всё архивом»
+    keyboard = [[t['name'], EXPORT_PREFIX + t['name']] for t in topics] + [[EXPORT_ALL]]
     await update.message.reply_text(
-        "Выберите тему:",
+        "Выберите тему (📦 — все файлы одним архивом):",
         reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
     )
     return SELECT_TOPIC
 
 async def select_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     topic_name = update.message.text.strip()
-    subject_id = context.user_data['subject_id']
-    conn = get_db_connection()
-    topic = conn.execute(
-        'SELECT id FROM topics WHERE subject_id = ? AND LOWER(name) = LOWER(?)',
-        (subject_id, topic_name)
-    ).fetchone()
-    if not topic:
+    subject_id = context.user_data.subject_id
+    if topic_name.startswith(EXPORT_PREFIX):
+        user_id = update.effective_user.id
+        if user_id in exporting_users:
+            await update.message.reply_text("⏳ Предыдущий архив ещё собирается, подождите.")
+        else:
+            # Сборка может занять минуты — не держим очередь обновлений остальных
+            exporting_users.add(user_id)
+            context.application.create_task(
+                send_archive(update, context, subject_id, topic_name[len(EXPORT_PREFIX):].strip()),
+                update=update
+            )
+        await menu(update, context)
+        return ConversationHandler.END
+    topic_id = storage.find_topic_id(subject_id, topic_name)
+    if not topic_id:
         await update.message.reply_text("Тема не найдена.")
         await menu(update, context)  # ✅ Возвращаемся к меню
         return ConversationHandler.END
-    materials = conn.execute(
-        'SELECT id, file_name, telegram_file_id FROM materials WHERE topic_id = ?',
-        (topic['id'],)
-    ).fetchall()
-    conn.close()
+    materials = storage.list_materials(topic_id)
     if not materials:
         await update.message.reply_text("Нет материалов по этой теме.")
     else:
-        for mat in materials:
-            file_name = mat['file_name']
-            if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
-                await update.message.reply_photo(photo=mat['telegram_file_id'])
-            elif file_name.lower().endswith(('.mp4', '.avi', '.mov')):
-                await update.message.reply_video(video=mat['telegram_file_id'])
-            else:
-                await update.message.reply_document(
-                    document=mat['telegram_file_id'],
-                    filename=mat['file_name']
-                )
-            # Увеличиваем счётчик скачиваний
-            conn = get_db_connection()
-            conn.execute(
-                'UPDATE materials SET downloads_count = downloads_count + 1 WHERE id = ?',
-                (mat['id'],)
-            )
-            conn.commit()
-            conn.close()
+        sent = []
+        try:
+            for mat in materials:
+                file_name = mat['file_name']
+                if file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    await update.message.reply_photo(photo=mat['telegram_file_id'])
+                elif file_name.lower().endswith(('.mp4', '.avi', '.mov')):
+                    await update.message.reply_video(video=mat['telegram_file_id'])
+                else:
+                    await update.message.reply_document(
+                        document=mat['telegram_file_id'],
+                        filename=mat['file_name']
+                    )
+                sent.append(mat['id'])
+        finally:
+            # Увеличиваем счётчики скачиваний одной транзакцией
+            storage.record_downloads(sent)
 
     await menu(update, context)  # ✅ Возвращаемся к меню
     return ConversationHandler.END  # ✅ Завершаем диалог
 
+async def send_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, subject_id, topic_name):
+    """Фоновая задача: отправляет все материалы темы (или всего предмета) одним ZIP-архивом"""
+    try:
+        await _send_archive(update, context, subject_id, topic_name)
+    finally:
+        exporting_users.discard(update.effective_user.id)
+
+async def _send_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, subject_id, topic_name):
+    if update.message.text.strip() == EXPORT_ALL:
+        scope, scope_id = 'subject', subject_id
+        materials = storage.list_subject_materials(subject_id)
+        # В архиве предмета файлы разложены по папкам тем
+        entries = [((m['topic_name'], m['file_name']), m['telegram_file_id']) for m in materials]
+        archive_name = storage.get_subject_name(subject_id) or 'материалы'
+    else:
+        topic_id = storage.find_topic_id(subject_id, topic_name)
+        if not topic_id:
+            await update.message.reply_text("Тема не найдена.")
+            return
+        scope, scope_id = 'topic', topic_id
+        materials = storage.list_materials(topic_id)
+        entries = [(m['file_name'], m['telegram_file_id']) for m in materials]
+        archive_name = topic_name
+    if not materials:
+        await update.message.reply_text("Нет материалов для архива.")
+        return
+
+    # Если содержимое не менялось, архив уже лежит на серверах Telegram
+    version = export.content_version(materials)
+    file_id = storage.get_cached_archive(scope, scope_id, version)
+    if file_id:
+        metrics.inc('archive_cache_hits')
+        await update.message.reply_document(document=file_id, filename=f'{archive_name}.zip')
+        storage.record_downloads([m['id'] for m in materials])
+        return
+    metrics.inc('archive_cache_misses')
+
+    if export_slots.locked():
+        await update.message.reply_text("⏳ Сейчас собираются другие архивы, ваш — следующий в очереди.")
+    async with export_slots:
+        await update.message.reply_text(f"⏳ Собираю архив, файлов: {len(materials)}...")
+        with tempfile.TemporaryFile() as archive:
+            try:
+                failed = await export.build_archive(
+                    entries, export.telegram_fetcher(context.bot), archive, concurrency=EXPORT_CONCURRENCY
+                )
+            except export.ArchiveTooLarge:
+                await update.message.reply_text("❌ Архив больше 50 МБ — Telegram не даст его отправить. Выберите отдельную тему.")
+                return
+            except Exception as e:
+                logging.error(f"Ошибка при сборке архива: {e}")
+                await update.message.reply_text("❌ Не удалось собрать архив.")
+                return
+            archive.seek(0)
+            message = await update.message.reply_document(document=archive, filename=f'{archive_name}.zip')
+    # Неполный архив не кэшируем: в следующий раз попробуем скачать всё заново
+    if not failed:
+        storage.save_cached_archive(scope, scope_id, version, message.document.file_id)
+    storage.record_downloads([m['id'] for m in materials])
+
 # --- Преподаватель: добавить материал ---
 async def add_material(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_teacher(update.effective_user.id):
         await update.message.reply_text("Только преподаватели могут загружать материалы.")
         return ConversationHandler.END
-    conn = get_db_connection()
-    subjects = conn.execute('SELECT name FROM subjects').fetchall()
-    conn.close()
+    subjects = storage.list_subjects()
     keyboard = [[s['name']] for s in subjects] + [['➕ Новый предмет']]
     await update.message.reply_text(
         "Выберите предмет или создайте новый:",
@@ -299,13 +374,11 @@ async def upload_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return UPLOAD_EXISTING_SUBJECT
     else:
         # Это выбор существующего предмета
-        conn = get_db_connection()
-        subject = conn.execute('SELECT id FROM subjects WHERE name = ?', (text,)).fetchone()
-        conn.close()
-        if not subject:
+        subject_id = storage.get_subject_id(text)
+        if not subject_id:
             await update.message.reply_text("Предмет не найден. Попробуйте снова.")
             return UPLOAD_SUBJECT
-        context.user_data['subject_id'] = subject['id']
+        context.user_data.subject_id = subject_id
         await update.message.reply_text("Введите название темы:")
         return UPLOAD_TOPIC
 
@@ -314,19 +387,13 @@ async def upload_existing_subject(update: Update, context: ContextTypes.DEFAULT_
     if not subject_name:
         await update.message.reply_text("Некорректное название. Попробуйте снова.")
         return UPLOAD_EXISTING_SUBJECT
-    conn = get_db_connection()
-    try:
-        conn.execute('INSERT INTO subjects (name) VALUES (?)', (subject_name,))
-        conn.commit()
-        subject = conn.execute('SELECT id FROM subjects WHERE name = ?', (subject_name,)).fetchone()
-        context.user_data['subject_id'] = subject['id']
-        await update.message.reply_text("Теперь введите название темы:")
-        return UPLOAD_TOPIC
-    except sqlite3.IntegrityError:
+    subject_id = storage.create_subject(subject_name)
+    if not subject_id:
         await update.message.reply_text("Предмет уже существует. Введите другое название.")
         return UPLOAD_EXISTING_SUBJECT
-    finally:
-        conn.close()
+    context.user_data.subject_id = subject_id
+    await update.message.reply_text("Теперь введите название темы:")
+    return UPLOAD_TOPIC
 
 async def upload_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     topic_name = update.message.text.strip()
@@ -334,35 +401,26 @@ async def upload_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Название темы не может быть пустым. Попробуйте снова.")
         return UPLOAD_TOPIC
 
-    subject_id = context.user_data['subject_id']
-    conn = get_db_connection()
+    subject_id = context.user_data.subject_id
     try:
         # Проверяем, существует ли тема
-        existing_topic = conn.execute(
-            'SELECT id FROM topics WHERE subject_id = ? AND LOWER(name) = LOWER(?)',
-            (subject_id, topic_name)
-        ).fetchone()
+        topic_id = storage.find_topic_id(subject_id, topic_name)
 
-        if existing_topic:
+        if topic_id:
             # Тема уже существует — используем её ID
-            topic_id = existing_topic['id']
             await update.message.reply_text(f"✅ Тема '{topic_name}' уже существует. Файл будет добавлен туда.")
         else:
             # Тема не существует — создаём новую
-            conn.execute('INSERT INTO topics (subject_id, name) VALUES (?, ?)', (subject_id, topic_name))
-            topic_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
-            conn.commit()
+            topic_id = storage.create_topic(subject_id, topic_name)
             await update.message.reply_text(f"✅ Тема '{topic_name}' создана. Теперь отправьте файл.")
 
-        context.user_data['topic_id'] = topic_id
+        context.user_data.topic_id = topic_id
         await update.message.reply_text("Отправьте файл (PDF, DOC, PPT, фото, видео и т.д.):")
         return UPLOAD_FILE
     except Exception as e:
         logging.error(f"Ошибка при создании/поиске темы: {e}")
         await update.message.reply_text("❌ Произошла ошибка. Попробуйте снова.")
         return ConversationHandler.END
-    finally:
-        conn.close()
 
 async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -380,8 +438,8 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_id = photo_obj.file_id
         # Спрашиваем название файла
         await update.message.reply_text("Введите название файла (например: 'Лекция 1'): ")
-        context.user_data['temp_file_id'] = file_id  # ✅ Сохраняем ID файла
-        context.user_data['temp_file_type'] = 'photo'  # ✅ Тип файла
+        context.user_data.temp_file_id = file_id  # ✅ Сохраняем ID файла
+        context.user_data.temp_file_type = 'photo'  # ✅ Тип файла
         return UPLOAD_FILE  # ⚠️ Переход к следующему шагу — ввод названия
 
     elif video:
@@ -389,8 +447,8 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_id = video_obj.file_id
         # Спрашиваем название файла
         await update.message.reply_text("Введите название файла (например: 'Видеоурок'): ")
-        context.user_data['temp_file_id'] = file_id  # ✅ Сохраняем ID файла
-        context.user_data['temp_file_type'] = 'video'  # ✅ Тип файла
+        context.user_data.temp_file_id = file_id  # ✅ Сохраняем ID файла
+        context.user_data.temp_file_type = 'video'  # ✅ Тип файла
         return UPLOAD_FILE  # ⚠️ Переход к следующему шагу — ввод названия
 
     elif document:
@@ -430,24 +488,19 @@ async def upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         file_id = document.file_id
 
-        topic_id = context.user_data.get('topic_id')
+        topic_id = context.user_data.topic_id
         if not topic_id:
             await update.message.reply_text("❌ Тема не была создана. Попробуйте снова.")
             return ConversationHandler.END
 
-        conn = get_db_connection()
         try:
-            conn.execute(
-                'INSERT INTO materials (topic_id, file_name, telegram_file_id, uploaded_by) VALUES (?, ?, ?, ?)',
-                (topic_id, file_name, file_id, user.id)
-            )
-            conn.commit()
+            storage.add_material(topic_id, file_name, file_id, user.id)
+            if notifier:
+                notifier.wakeup()
             await update.message.reply_text("✅ Материал успешно сохранён!")
         except Exception as e:
             logging.error(f"Ошибка при сохранении материала: {e}")
             await update.message.reply_text("❌ Произошла ошибка при сохранении файла. Попробуйте снова.")
-        finally:
-            conn.close()
 
         await menu(update, context)  # ✅ Возвращаемся к главному меню
         return ConversationHandler.END
@@ -461,8 +514,8 @@ async def ask_for_file_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return UPLOAD_FILE
 
     # Получаем ID файла и тип
-    file_id = context.user_data.get('temp_file_id')
-    file_type = context.user_data.get('temp_file_type')
+    file_id = context.user_data.temp_file_id
+    file_type = context.user_data.temp_file_type
 
     if not file_id or not file_type:
         await update.message.reply_text("❌ Не удалось сохранить файл. Попробуйте снова.")
@@ -474,29 +527,24 @@ async def ask_for_file_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif file_type == 'video':
         file_name += '.mp4'
 
-    topic_id = context.user_data.get('topic_id')
+    topic_id = context.user_data.topic_id
     if not topic_id:
         await update.message.reply_text("❌ Тема не была создана. Попробуйте снова.")
         return ConversationHandler.END
 
     user = update.effective_user
-    conn = get_db_connection()
     try:
-        conn.execute(
-            'INSERT INTO materials (topic_id, file_name, telegram_file_id, uploaded_by) VALUES (?, ?, ?, ?)',
-            (topic_id, file_name, file_id, user.id)
-        )
-        conn.commit()
+        storage.add_material(topic_id, file_name, file_id, user.id)
+        if notifier:
+            notifier.wakeup()
         await update.message.reply_text(f"✅ Материал '{file_name}' успешно сохранён!")
     except Exception as e:
         logging.error(f"Ошибка при сохранении фото/видео: {e}")
         await update.message.reply_text("❌ Произошла ошибка при сохранении файла. Попробуйте снова.")
-    finally:
-        conn.close()
 
     # Очищаем временные данные
-    context.user_data.pop('temp_file_id', None)
-    context.user_data.pop('temp_file_type', None)
+    context.user_data.temp_file_id = None
+    context.user_data.temp_file_type = None
 
     await menu(update, context)  # ✅ Возвращаемся к главному меню
     return ConversationHandler.END
@@ -512,18 +560,7 @@ async def search_by_topic_or_subject_name(update: Update, context: ContextTypes.
         await update.message.reply_text("Запрос не может быть пустым.")
         return SEARCH_FILE_NAME
 
-    conn = get_db_connection()
-    materials = conn.execute(
-        '''
-        SELECT m.file_name, m.telegram_file_id, t.name as topic_name, s.name as subject_name
-        FROM materials m
-        JOIN topics t ON m.topic_id = t.id
-        JOIN subjects s ON t.subject_id = s.id
-        WHERE LOWER(t.name) LIKE LOWER(?) OR LOWER(s.name) LIKE LOWER(?) OR LOWER(m.file_name) LIKE LOWER(?)
-        ''',
-        (f'%{query}%', f'%{query}%', f'%{query}%')
-    ).fetchall()
-    conn.close()
+    materials = storage.search_materials(query)
 
     if not materials:
         await update.message.reply_text("Файлы не найдены.")
@@ -549,9 +586,7 @@ async def view_topics(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Только преподаватели могут просматривать темы.")
         return ConversationHandler.END
 
-    conn = get_db_connection()
-    subjects = conn.execute('SELECT name FROM subjects').fetchall()
-    conn.close()
+    subjects = storage.list_subjects()
     if not subjects:
         await update.message.reply_text("Нет доступных предметов.")
         return ConversationHandler.END
@@ -565,15 +600,13 @@ async def view_topics(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def view_topics_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     subject_name = update.message.text.strip()
-    conn = get_db_connection()
-    subject = conn.execute('SELECT id FROM subjects WHERE name = ?', (subject_name,)).fetchone()
-    if not subject:
+    subject_id = storage.get_subject_id(subject_name)
+    if not subject_id:
         await update.message.reply_text("Предмет не найден.")
         await menu(update, context)  # ✅ Возвращаемся к главному меню
         return ConversationHandler.END
 
-    topics = conn.execute('SELECT name FROM topics WHERE subject_id = ?', (subject['id'],)).fetchall()
-    conn.close()
+    topics = storage.list_topics(subject_id)
 
     if not topics:
         await update.message.reply_text("В этом предмете нет тем.")
@@ -596,17 +629,15 @@ async def delete_replace_material(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
     )
     # Сохраняем тип действия
-    context.user_data['action'] = 'delete' if update.message.text == '🗑 Удалить материал' else 'replace'
+    context.user_data.action = 'delete' if update.message.text == '🗑 Удалить материал' else 'replace'
     return DELETE_MATERIAL_SELECT_SUBJECT
 
 # Удаление: шаг 1 - выбор предмета
 async def delete_material_select_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = 'delete' if 'удалить' in update.message.text.lower() else 'replace'
-    context.user_data['action'] = action
+    context.user_data.action = action
 
-    conn = get_db_connection()
-    subjects = conn.execute('SELECT name FROM subjects').fetchall()
-    conn.close()
+    subjects = storage.list_subjects()
     if not subjects:
         await update.message.reply_text("Нет доступных предметов.")
         return ConversationHandler.END
@@ -621,14 +652,12 @@ async def delete_material_select_subject(update: Update, context: ContextTypes.D
 # Удаление: шаг 2 - выбор темы
 async def delete_material_select_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     subject_name = update.message.text.strip()
-    conn = get_db_connection()
-    subject = conn.execute('SELECT id FROM subjects WHERE name = ?', (subject_name,)).fetchone()
-    if not subject:
+    subject_id = storage.get_subject_id(subject_name)
+    if not subject_id:
         await update.message.reply_text("Предмет не найден.")
         return ConversationHandler.END
-    context.user_data['subject_id'] = subject['id']
-    topics = conn.execute('SELECT name FROM topics WHERE subject_id = ?', (subject['id'],)).fetchall()
-    conn.close()
+    context.user_data.subject_id = subject_id
+    topics = storage.list_topics(subject_id)
     if not topics:
         await update.message.reply_text("Нет тем по этому предмету.")
         return ConversationHandler.END
@@ -642,69 +671,52 @@ async def delete_material_select_topic(update: Update, context: ContextTypes.DEF
 # Удаление/замена: шаг 3 - выбор файла
 async def delete_material_select_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
-    print(f"[DEBUG] Получен текст: '{text}'")  # 🔍 Отладка
+    logging.debug(f"Получен текст: '{text}'")
 
     # Проверяем, это выбор файла (ID: название) или название темы
     if ':' in text and text.split(':')[0].isdigit():
         # Это выбор файла
         file_id = int(text.split(':')[0])
-        print(f"[DEBUG] Это выбор файла, ID={file_id}")  # 🔍 Отладка
+        logging.debug(f"Это выбор файла, ID={file_id}")
 
-        action = context.user_data.get('action', 'delete')
+        action = context.user_data.action or 'delete'
         if action == 'replace':
             # --- Замена ---
             await update.message.reply_text("Теперь отправьте новый файл.")
-            context.user_data['old_file_id'] = file_id  # ✅ Сохраняем ID файла для замены
+            context.user_data.old_file_id = file_id  # ✅ Сохраняем ID файла для замены
             return REPLACE_MATERIAL_NEW_FILE
         else:
             # --- Удаление ---
-            conn = get_db_connection()
             try:
                 # Удаляем файл
-                conn.execute('DELETE FROM materials WHERE id = ?', (file_id,))
-                conn.commit()
+                storage.delete_material(file_id)
                 await update.message.reply_text("✅ Материал успешно удалён!")
 
-                # Проверяем, остались ли материалы в теме
-                topic_id = context.user_data.get('topic_id')
-                if topic_id:
-                    remaining = conn.execute('SELECT COUNT(*) FROM materials WHERE topic_id = ?', (topic_id,)).fetchone()[0]
-                    if remaining == 0:
-                        # Удаляем тему, если в ней не осталось материалов
-                        conn.execute('DELETE FROM topics WHERE id = ?', (topic_id,))
-                        conn.commit()
-                        await update.message.reply_text("⚠️ В теме не осталось материалов — тема удалена.")
+                # Удаляем тему, если в ней не осталось материалов
+                topic_id = context.user_data.topic_id
+                if topic_id and storage.delete_topic_if_empty(topic_id):
+                    await update.message.reply_text("⚠️ В теме не осталось материалов — тема удалена.")
 
             except Exception as e:
                 logging.error(f"Ошибка при удалении: {e}")
                 await update.message.reply_text("❌ Произошла ошибка при удалении файла.")
-            finally:
-                conn.close()
 
             await menu(update, context)  # ✅ Возвращаемся к главному меню
             return ConversationHandler.END
     else:
         # Это название темы
         topic_name = text
-        subject_id = context.user_data['subject_id']
-        print(f"[DEBUG] subject_id={subject_id}, topic_name='{topic_name}'")  # 🔍 Отладка
-        conn = get_db_connection()
+        subject_id = context.user_data.subject_id
+        logging.debug(f"subject_id={subject_id}, topic_name='{topic_name}'")
         # Гибкий поиск темы — без учёта регистра и пробелов
-        topic = conn.execute(
-            'SELECT id FROM topics WHERE subject_id = ? AND LOWER(name) = LOWER(?)',
-            (subject_id, topic_name.strip())
-        ).fetchone()
-        print(f"[DEBUG] Результат поиска темы: {topic}")  # 🔍 Отладка
-        if not topic:
+        topic_id = storage.find_topic_id(subject_id, topic_name.strip())
+        logging.debug(f"Результат поиска темы: {topic_id}")
+        if not topic_id:
             await update.message.reply_text("❌ Тема не найдена.")
             await menu(update, context)  # ✅ Возвращаемся к главному меню
             return ConversationHandler.END
-        context.user_data['topic_id'] = topic['id']
-        materials = conn.execute(
-            'SELECT id, file_name FROM materials WHERE topic_id = ?',
-            (topic['id'],)
-        ).fetchall()
-        conn.close()
+        context.user_data.topic_id = topic_id
+        materials = storage.list_materials(topic_id)
         if not materials:
             await update.message.reply_text("❌ Нет материалов по этой теме.")
             await menu(update, context)  # ✅ Возвращаемся к главному меню
@@ -786,123 +798,285 @@ async def replace_material_new_file(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("Пожалуйста, отправьте файл.")
         return REPLACE_MATERIAL_NEW_FILE
 
-    old_file_id = context.user_data.get('old_file_id')
+    old_file_id = context.user_data.old_file_id
 
     if not old_file_id:
         await update.message.reply_text("❌ Не удалось найти файл для замены.")
         await menu(update, context)  # ✅ Возвращаемся к главному меню
         return ConversationHandler.END
 
-    conn = get_db_connection()
     try:
         logging.debug(f"[replace_material_new_file] Попытка замены файла ID={old_file_id} на {file_name}, file_id={file_id}")
 
-        conn.execute(
-            'UPDATE materials SET file_name = ?, telegram_file_id = ? WHERE id = ?',
-            (file_name, file_id, old_file_id)
-        )
-        conn.commit()
+        storage.replace_material(old_file_id, file_name, file_id)
         await update.message.reply_text("✅ Материал успешно заменён!")
     except Exception as e:
         logging.error(f"Ошибка при замене: {e}")
         await update.message.reply_text("❌ Произошла ошибка при замене файла.")
-    finally:
-        conn.close()
 
     await menu(update, context)  # ✅ Возвращаемся к главному меню
     return ConversationHandler.END
 
+# --- Подписки на предметы ---
+async def subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    subjects = storage.list_subjects()
+    subscribed = storage.subscribed_subject_ids(update.effective_user.id)
+    if not subjects:
+        await update.message.reply_text("Нет доступных предметов.")
+        return ConversationHandler.END
+    keyboard = [[('✅ ' if s['id'] in subscribed else '') + s['name']] for s in subjects]
+    await update.message.reply_text(
+        "Выберите предмет, чтобы подписаться на новые материалы (✅ — уже подписаны, нажмите ещё раз, чтобы отписаться):",
+        reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+    )
+    return SUBSCRIBE_SUBJECT
+
+async def subscribe_subject(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    subject_name = update.message.text.strip()
+    if subject_name.startswith('✅ '):
+        subject_name = subject_name[2:]
+    subject_id = storage.get_subject_id(subject_name)
+    if not subject_id:
+        await update.message.reply_text("Предмет не найден.")
+    elif storage.toggle_subscription(update.effective_user.id, subject_id):
+        await update.message.reply_text(f"🔔 Вы подписаны на новые материалы по предмету '{subject_name}'.")
+    else:
+        await update.message.reply_text(f"🔕 Вы отписались от предмета '{subject_name}'.")
+
+    await menu(update, context)  # ✅ Возвращаемся к главному меню
+    return ConversationHandler.END
+
+# --- Защита от флуда ---
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отбрасывает повторы и слишком частые запросы до того, как они дойдут до БД"""
+    user = update.effective_user
+    if not user:
+        return
+    text = update.message.text if update.message else None
+    verdict = flood_limiter.check(user.id, text)
+    if verdict == flood.ALLOW:
+        return
+    metrics.inc(f'flood_{verdict}')
+    if verdict == flood.LIMITED and update.effective_message and flood_limiter.should_warn(user.id):
+        await update.effective_message.reply_text("⏳ Слишком много запросов. Подождите немного.")
+    raise ApplicationHandlerStop
+
+# --- Сессии ---
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмечает активность пользователя (вызывается до всех остальных обработчиков)"""
+    if update.effective_user:
+        context.user_data.last_seen = time.time()
+
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()
+    metrics.inc('conversations_timed_out')
+    if update.effective_message:
+        await update.effective_message.reply_text("⌛ Диалог завершён из-за неактивности. Нажмите /start, чтобы начать заново.")
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    sessions.sweep(context.application, SESSION_IDLE_TTL, MAX_SESSIONS)
+
+# --- Обслуживание БД ---
+async def backup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await maintenance.backup(DB_PATH, BACKUP_DIR, keep=BACKUP_KEEP)
+    except Exception as e:
+        logging.error(f"Ошибка при бэкапе БД: {e}")
+
+async def maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await maintenance.optimize(DB_PATH)
+    except Exception as e:
+        logging.error(f"Ошибка при обслуживании БД: {e}")
+
+# --- Команда /metrics ---
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    OWNER_ID = int(os.getenv("OWNER_ID", 0))
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("Доступ запрещён.")
+        return
+    await update.message.reply_text(metrics.render())
+
+# --- Замеры запуска ---
+# Этап -> секунды; этап длится от конца предыдущего до вызова startup_stage
+startup_timings = {}
+_stage_started = time.perf_counter()
+
+def begin_startup():
+    global _stage_started
+    startup_timings.clear()
+    _stage_started = time.perf_counter()
+
+def startup_stage(name):
+    global _stage_started
+    now = time.perf_counter()
+    startup_timings[name] = now - _stage_started
+    _stage_started = now
+
+def report_startup(details=''):
+    for name, seconds in startup_timings.items():
+        metrics.counters[f'startup_{name}_ms'] = round(seconds * 1000)
+    stages = ', '.join(f'{name} {seconds * 1000:.0f} мс' for name, seconds in startup_timings.items())
+    logging.info(f"Запуск за {sum(startup_timings.values()) * 1000:.0f} мс: {stages}{details}")
+
+# --- Фоновая рассылка ---
+async def post_init(application: Application):
+    # Application.initialize: загрузка persistence и getMe
+    startup_stage('initialize')
+    report_startup(application.bot_data.pop('startup_details', ''))
+    if notifier is None:
+        return  # рассылка работает только поверх SQLite
+    application.bot_data['notifier_task'] = asyncio.create_task(notifier.run(application.bot))
+
+async def post_shutdown(application: Application):
+    task = application.bot_data.pop('notifier_task', None)
+    if task:
+        task.cancel()
+    storage.close()
+
 # --- Запуск ---
-def main():
-    BOT_TOKEN = os.getenv("BOT_TOKEN", "ВСТАВЬ_ТОКЕН_ЗДЕСЬ")
+def conversation(name, button, entry, states):
+    """Диалог с общими для всех настройками: вход по кнопке, /start, таймаут, persistence"""
+    return ConversationHandler(
+        entry_points=[MessageHandler(filters.Text(button), entry)],
+        states={**states, ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)]},
+        fallbacks=[CommandHandler('start', start)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name=name,
+        persistent=True
+    )
+
+def build_application(persistence, primary=True, updater=True):
+    """Application со всеми обработчиками; фоновые задачи БД — только в primary"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f'{TELEGRAM_API_URL}/bot')
+        .base_file_url(f'{TELEGRAM_API_URL}/file/bot')
+        .context_types(ContextTypes(user_data=sessions.Session))
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
 
-    init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Защита от флуда — раньше всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, flood_guard), group=-2)
+
+    # Отмечаем активность до всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, touch_session), group=-1)
+    application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL)
+
+    # Бэкапы и обслуживание БД
+    if primary and isinstance(base_storage, SQLiteStorage):
+        application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL, first=60)
+        application.job_queue.run_repeating(maintenance_job, interval=MAINTENANCE_INTERVAL, first=MAINTENANCE_INTERVAL)
 
     # Команды
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('add_teacher', add_teacher))
+    application.add_handler(CommandHandler('metrics', show_metrics))
 
     # Обработчик кнопки "Статистика скачиваний"
     application.add_handler(MessageHandler(filters.Text("📈 Статистика скачиваний"), show_stats))
 
+    text = filters.TEXT & ~filters.COMMAND
+    media = filters.Document.ALL | filters.PHOTO | filters.VIDEO
+
     # Диалог для поиска материала
-    find_conv = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text("📚 Найти материал"), find_material)],
-        states={
-            SELECT_SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_subject)],
-            SELECT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_topic)],
-        },
-        fallbacks=[CommandHandler('start', start)]
-    )
+    find_conv = conversation('find', "📚 Найти материал", find_material, {
+        SELECT_SUBJECT: [MessageHandler(text, select_subject)],
+        SELECT_TOPIC: [MessageHandler(text, select_topic)],
+    })
 
     # Диалог для загрузки материала
-    upload_conv = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text("➕ Добавить материал"), add_material)],
-        states={
-            UPLOAD_SUBJECT: [
-                MessageHandler(filters.Text("➕ Новый предмет"), upload_subject),
-                MessageHandler(filters.TEXT & ~filters.COMMAND, upload_subject)
-            ],
-            UPLOAD_EXISTING_SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, upload_existing_subject)],
-            UPLOAD_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, upload_topic)],
-            UPLOAD_FILE: [
-                MessageHandler(filters.Document.ALL | filters.PHOTO | filters.VIDEO, upload_file),  # ✅ Обработка файла
-                MessageHandler(filters.TEXT & ~filters.COMMAND, ask_for_file_name)  # ✅ Обработка названия файла
-            ],
-        },
-        fallbacks=[CommandHandler('start', start)]
-    )
+    upload_conv = conversation('upload', "➕ Добавить материал", add_material, {
+        UPLOAD_SUBJECT: [
+            MessageHandler(filters.Text("➕ Новый предмет"), upload_subject),
+            MessageHandler(text, upload_subject)
+        ],
+        UPLOAD_EXISTING_SUBJECT: [MessageHandler(text, upload_existing_subject)],
+        UPLOAD_TOPIC: [MessageHandler(text, upload_topic)],
+        UPLOAD_FILE: [
+            MessageHandler(media, upload_file),  # ✅ Обработка файла
+            MessageHandler(text, ask_for_file_name)  # ✅ Обработка названия файла
+        ],
+    })
 
     # Диалог для поиска по теме/предмету
-    search_conv = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text("🔍 Поиск по теме/предмету"), search_by_topic_or_subject)],
-        states={
-            SEARCH_FILE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_by_topic_or_subject_name)],
-        },
-        fallbacks=[CommandHandler('start', start)]
-    )
+    search_conv = conversation('search', "🔍 Поиск по теме/предмету", search_by_topic_or_subject, {
+        SEARCH_FILE_NAME: [MessageHandler(text, search_by_topic_or_subject_name)],
+    })
 
     # Диалог для просмотра тем
-    view_topics_conv = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text("📋 Просмотр тем в предмете"), view_topics)],
-        states={
-            VIEW_TOPICS_SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_topics_subject)],
-        },
-        fallbacks=[CommandHandler('start', start)]
+    view_topics_conv = conversation('view_topics', "📋 Просмотр тем в предмете", view_topics, {
+        VIEW_TOPICS_SUBJECT: [MessageHandler(text, view_topics_subject)],
+    })
+
+    # Удаление и замена — один и тот же диалог с разными кнопками входа.
+    # Имена 'delete' и 'replace' оставляем: под ними сохранены состояния в persistence
+    delete_states = {
+        DELETE_MATERIAL_SELECT_SUBJECT: [MessageHandler(text, delete_material_select_subject)],
+        DELETE_MATERIAL_SELECT_TOPIC: [MessageHandler(text, delete_material_select_topic)],
+        DELETE_MATERIAL_SELECT_FILE: [MessageHandler(text, delete_material_select_file)],
+        REPLACE_MATERIAL_NEW_FILE: [MessageHandler(media, replace_material_new_file)],
+    }
+    delete_conv = conversation('delete', "🗑 Удалить/заменить материал", delete_replace_material, delete_states)
+    replace_conv = conversation('replace', "🔄 Заменить материал", delete_replace_material, delete_states)
+
+    # Диалог для подписок
+    subscribe_conv = conversation('subscribe', "🔔 Подписки", subscriptions, {
+        SUBSCRIBE_SUBJECT: [MessageHandler(text, subscribe_subject)],
+    })
+
+    for conv in (find_conv, upload_conv, search_conv, view_topics_conv, delete_conv, replace_conv, subscribe_conv):
+        application.add_handler(conv)
+    return application
+
+def run_worker(index, count, updates, broadcast):
+    """Процесс-обработчик: чаты, для которых workers.partition(chat_id) == index"""
+    global notifier
+    if index != 0:
+        notifier = None  # рассылка одна на всех — в нулевом процессе
+    storage.publish = broadcast.publish
+    persistence = SQLitePersistence(
+        PERSISTENCE_DB, conversation_window=CONVERSATION_TIMEOUT,
+        owns=lambda chat_id: workers.partition(chat_id, count) == index
     )
-
-    # Диалог для удаления/замены
-    delete_conv = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text("🗑 Удалить/заменить материал"), delete_replace_material)],
-        states={
-            DELETE_MATERIAL_SELECT_SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_material_select_subject)],
-            DELETE_MATERIAL_SELECT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_material_select_topic)],
-            DELETE_MATERIAL_SELECT_FILE: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_material_select_file)],
-            REPLACE_MATERIAL_NEW_FILE: [MessageHandler(filters.Document.ALL | filters.PHOTO | filters.VIDEO, replace_material_new_file)],  # ✅ Добавлено
-        },
-        fallbacks=[CommandHandler('start', start)]
-    )
-
-    # Диалог для замены
-    replace_conv = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text("🔄 Заменить материал"), delete_replace_material)],
-        states={
-            DELETE_MATERIAL_SELECT_SUBJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_material_select_subject)],
-            DELETE_MATERIAL_SELECT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_material_select_topic)],
-            DELETE_MATERIAL_SELECT_FILE: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_material_select_file)],
-            REPLACE_MATERIAL_NEW_FILE: [MessageHandler(filters.Document.ALL | filters.PHOTO | filters.VIDEO, replace_material_new_file)],  # ✅ Добавлено
-        },
-        fallbacks=[CommandHandler('start', start)]
+    begin_startup()
+    application = prepare_application(persistence, primary=index == 0, updater=False)
+    workers.serve(application, updates, broadcast, storage.apply)
+
+def prepare_application(persistence, **kwargs):
+    """Прогревает хранилище и собирает Application — всё до начала приёма обновлений"""
+    warm = storage.prewarm()
+    startup_stage('prewarm')
+    application = build_application(persistence, **kwargs)
+    startup_stage('build')  # в основном — SSL-контексты httpx
+    application.bot_data['startup_details'] = (
+        f" (преподавателей {warm['teachers']}, предметов {warm['subjects']}, тем {warm['topics']})"
     )
+    return application
 
-    application.add_handler(find_conv)
-    application.add_handler(upload_conv)
-    application.add_handler(search_conv)
-    application.add_handler(view_topics_conv)
-    application.add_handler(delete_conv)
-    application.add_handler(replace_conv)
-
+def main():
+    begin_startup()
+    # DDL выполняется, только если PRAGMA user_version отстаёт от storage.SCHEMA_VERSION
+    if storage.init_schema():
+        logging.info("Схема базы создана/обновлена")
+    # Старую базу один раз переводим на инкрементальный VACUUM — до приёма обновлений,
+    # пока полный VACUUM никому не мешает
+    if isinstance(base_storage, SQLiteStorage) and maintenance.enable_incremental_vacuum(DB_PATH):
+        logging.info("База переведена на auto_vacuum=INCREMENTAL")
+    startup_stage('schema')
+    if WORKERS > 1:
+        if not isinstance(base_storage, SQLiteStorage):
+            raise SystemExit("WORKERS > 1 работает только с STORAGE_BACKEND=sqlite")
+        storage.close()  # у каждого процесса будет своё соединение
+        workers.run(WORKERS, run_worker, BOT_TOKEN, TELEGRAM_API_URL)
+        return
+    application = prepare_application(SQLitePersistence(PERSISTENCE_DB, conversation_window=CONVERSATION_TIMEOUT))
     application.run_polling()
 
 if __name__ == '__main__':
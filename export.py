@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+
+import httpx
+
+# Выгрузка всех материалов темы или предмета одним ZIP-архивом.
+#
+# Файлы скачиваются параллельно (не больше concurrency одновременно), каждый —
+# в SpooledTemporaryFile: небольшие остаются в памяти, крупные уходят на диск.
+# Архив пишется во временный файл по кусочкам, так что сборка занимает в памяти
+# примерно concurrency * SPOOL_SIZE независимо от размера темы.
+#
+# Отправка — другое дело: PTB читает файл архива в память целиком (до
+# MAX_ARCHIVE_SIZE), поэтому число одновременных сборок и отправок ограничивает
+# вызывающий (bot.export_slots).
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+# Бот может скачивать файлы до 20 МБ и отправлять документы до 50 МБ
+MAX_FILE_SIZE = 20 * 1024 * 1024
+MAX_ARCHIVE_SIZE = 50 * 1024 * 1024
+
+# Уже сжатые форматы кладём без повторного сжатия
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp4', '.avi', '.mov', '.docx', '.pptx', '.zip')
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class ArchiveTooLarge(Exception):
+    pass
+
+
+def content_version(materials):
+    """Версия содержимого: меняется при добавлении, удалении или замене любого файла"""
+    digest = hashlib.sha1()
+    for mat in sorted(materials, key=lambda m: m['id']):
+        digest.update(f"{mat['id']}:{mat['telegram_file_id']}:{mat['file_name']}\n".encode())
+    return digest.hexdigest()
+
+
+class HttpFetcher:
+    """Скачивает файл по URL, который возвращает resolve_url(file_id)"""
+
+    def __init__(self, resolve_url, client=None):
+        self.resolve_url = resolve_url
+        self.client = client
+
+    async def fetch(self, file_id, out):
+        url = await self.resolve_url(file_id)
+        client = self.client or httpx.AsyncClient(timeout=60)
+        try:
+            async with client.stream('GET', url) as response:
+                response.raise_for_status()
+                size = 0
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_FILE_SIZE:
+                        raise FileTooLarge(file_id)
+                    out.write(chunk)
+        finally:
+            if self.client is None:
+                await client.aclose()
+
+
+def telegram_fetcher(bot, client=None):
+    async def resolve_url(file_id):
+        telegram_file = await bot.get_file(file_id)
+        if telegram_file.file_size and telegram_file.file_size > MAX_FILE_SIZE:
+            raise FileTooLarge(file_id)
+        return telegram_file.file_path
+
+    return HttpFetcher(resolve_url, client)
+
+
+def safe_component(name):
+    """Одна часть пути в архиве: без разделителей, '..' и ведущих точек"""
+    name = name.replace('/', '_').replace('\\', '_').replace('\0', '').replace('..', '_')
+    return name.lstrip('. ').strip() or '_'
+
+
+def unique_names(entries):
+    """Имена внутри архива: безопасные и уникальные — 'a.pdf', 'a (2).pdf', ...
+
+    Имя в entries — строка или кортеж частей пути (папка темы, файл); названия
+    вводят пользователи, поэтому каждая часть очищается, а '/' ставим только мы.
+    """
+    seen = set()
+    result = []
+    for path, file_id in entries:
+        parts = (path,) if isinstance(path, str) else path
+        arcname = '/'.join(safe_component(part) for part in parts)
+        base, ext = os.path.splitext(arcname)
+        name, n = arcname, 1
+        while name.lower() in seen:
+            n += 1
+            name = f'{base} ({n}){ext}'
+        seen.add(name.lower())
+        result.append((name, file_id))
+    return result
+
+
+def _write_entry(archive, arcname, source):
+    compression = zipfile.ZIP_STORED if arcname.lower().endswith(STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+    info = zipfile.ZipInfo(arcname)
+    info.compress_type = compression
+    source.seek(0)
+    with archive.open(info, 'w', force_zip64=True) as dest:
+        shutil.copyfileobj(source, dest, CHUNK_SIZE)
+
+
+async def build_archive(entries, fetcher, out, concurrency=4, max_size=MAX_ARCHIVE_SIZE):
+    """Скачивает entries [(имя или кортеж частей пути, file_id)] и пишет ZIP в out.
+
+    Возвращает список имён, которые не удалось добавить. Как только архив
+    перерастает max_size, бросает ArchiveTooLarge — дальше не скачиваем.
+    """
+    entries = unique_names(entries)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(file_id):
+        async with semaphore:
+            buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            try:
+                await fetcher.fetch(file_id, buffer)
+            except Exception:
+                buffer.close()
+                raise
+            return buffer
+
+    # Запускаем не больше concurrency загрузок вперёд, а пишем строго по порядку
+    tasks = {}
+    failed = []
+    try:
+        with zipfile.ZipFile(out, 'w') as archive:
+            await _fill_archive(archive, out, entries, download, tasks, failed, concurrency, max_size)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return failed
+
+
+async def _fill_archive(archive, out, entries, download, tasks, failed, concurrency, max_size):
+    for i, (arcname, file_id) in enumerate(entries):
+        for j in range(i, min(i + concurrency, len(entries))):
+            if j not in tasks:
+                tasks[j] = asyncio.create_task(download(entries[j][1]))
+        try:
+            buffer = await tasks.pop(i)
+        except Exception as e:
+            logging.warning(f"Не удалось скачать {arcname} для архива: {e}")
+            failed.append(arcname)
+            continue
+        with buffer:
+            await asyncio.to_thread(_write_entry, archive, arcname, buffer)
+        if max_size is not None and out.tell() > max_size:
+            raise ArchiveTooLarge(arcname)
+    if failed:
+        archive.writestr('НЕ_ВОШЛО.txt', 'Не удалось добавить в архив:\n' + '\n'.join(failed))
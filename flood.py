@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+
+# Защита от флуда: token bucket на каждого пользователя и отбрасывание
+# одинаковых запросов подряд (например, одна и та же тема дважды за пару секунд).
+# Состояние хранится в OrderedDict ограниченного размера — при переполнении
+# вытесняются пользователи, которые дольше всех ничего не присылали.
+
+ALLOW = 'allow'
+DUPLICATE = 'duplicate'
+LIMITED = 'limited'
+
+
+class _Bucket:
+    __slots__ = ('tokens', 'updated', 'last_text', 'last_text_at', 'warned')
+
+    def __init__(self, capacity, now):
+        self.tokens = capacity
+        self.updated = now
+        self.last_text = None
+        self.last_text_at = 0.0
+        self.warned = False
+
+
+class FloodLimiter:
+    def __init__(self, rate=1.0, capacity=8, duplicate_window=3.0, max_users=50000):
+        self.rate = rate  # сколько запросов в секунду восстанавливается
+        self.capacity = capacity  # сколько запросов можно сделать подряд
+        self.duplicate_window = duplicate_window
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+
+    def check(self, user_id, text=None, now=None):
+        """Возвращает ALLOW, DUPLICATE или LIMITED"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(self.capacity, now)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+
+        if text is not None and text == bucket.last_text and now - bucket.last_text_at < self.duplicate_window:
+            return DUPLICATE
+
+        bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens < 1:
+            return LIMITED
+        bucket.tokens -= 1
+        bucket.warned = False
+        if text is not None:
+            bucket.last_text = text
+            bucket.last_text_at = now
+        return ALLOW
+
+    def should_warn(self, user_id):
+        """Предупреждаем о лимите один раз, пока пользователь не перестанет флудить"""
+        bucket = self._buckets.get(user_id)
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import metrics
+
+# Онлайн-бэкапы и обслуживание БД без остановки бота.
+#
+# Каждая операция выполняется в отдельном потоке (asyncio.to_thread) со своим
+# соединением, поэтому цикл обработки обновлений не блокируется.
+#
+# Бэкап делается через VACUUM INTO: копия снимается за одну транзакцию
+# чтения, а в WAL чтение не мешает боту писать. (Порционный backup API с
+# паузами тут не годится: любая запись в источник перезапускает копирование
+# с начала, а бот пишет постоянно — счётчики скачиваний.)
+
+
+def _backup(db_path, target_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute('VACUUM INTO ?', (target_path,))
+    finally:
+        conn.close()
+
+
+def rotate_backups(backup_dir, keep):
+    """Оставляет keep самых свежих бэкапов, остальные удаляет"""
+    backups = sorted(
+        name for name in os.listdir(backup_dir)
+        if name.startswith('materials-') and name.endswith('.db')
+    )
+    for name in backups[:-keep] if keep > 0 else []:
+        os.remove(os.path.join(backup_dir, name))
+    return backups[-keep:] if keep > 0 else backups
+
+
+async def backup(db_path, backup_dir, keep=7):
+    os.makedirs(backup_dir, exist_ok=True)
+    # Хвосты бэкапов, прерванных остановкой процесса
+    for stale in os.listdir(backup_dir):
+        if stale.endswith('.partial'):
+            os.remove(os.path.join(backup_dir, stale))
+    name = f"materials-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    target_path = os.path.join(backup_dir, name)
+    partial_path = target_path + '.partial'
+    started = time.monotonic()
+    try:
+        await asyncio.to_thread(_backup, db_path, partial_path)
+        os.replace(partial_path, target_path)  # недописанный бэкап не попадёт в ротацию
+    except Exception:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    rotate_backups(backup_dir, keep)
+    metrics.inc('backups_done')
+    logging.info(f"Бэкап {target_path} сделан за {time.monotonic() - started:.1f} с")
+    return target_path
+
+
+def enable_incremental_vacuum(db_path):
+    """Переводит существующую базу на auto_vacuum=INCREMENTAL (один раз, полным VACUUM).
+
+    VACUUM держит блокировку записи, поэтому вызывается при запуске, до приёма обновлений.
+    Возвращает True, если перевод понадобился.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+
+def _run_pragma(db_path, sql):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(sql).fetchall()
+    finally:
+        conn.close()
+
+
+async def optimize(db_path, vacuum_pages=200):
+    """ANALYZE/PRAGMA optimize, чекпоинт WAL и инкрементальный VACUUM — по шагу за раз"""
+    steps = [
+        'PRAGMA optimize',
+        'ANALYZE',
+        'PRAGMA wal_checkpoint(PASSIVE)',
+    ]
+    auto_vacuum = (await asyncio.to_thread(_run_pragma, db_path, 'PRAGMA auto_vacuum'))[0][0]
+    if auto_vacuum == 2:  # INCREMENTAL
+        steps.append(f'PRAGMA incremental_vacuum({int(vacuum_pages)})')
+    else:
+        logging.debug("auto_vacuum не INCREMENTAL — инкрементальный VACUUM пропущен (см. enable_incremental_vacuum)")
+
+    for sql in steps:
+        await asyncio.to_thread(_run_pragma, db_path, sql)
+        await asyncio.sleep(0)  # даём обработать накопившиеся обновления
+    metrics.inc('maintenance_runs')
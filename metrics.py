@@ -0,0 +1,22 @@
+from collections import Counter
+
+# Простые счётчики работы бота. Смотреть — командой /metrics (только владелец).
+
+counters = Counter()
+
+
+def inc(name, value=1):
+    counters[name] += value
+
+
+def render():
+    if not counters:
+        return "Метрик пока нет."
+    lines = [f'{name}: {value}' for name, value in sorted(counters.items())]
+    # Для пар *_hits / *_misses показываем долю попаданий
+    for name in sorted(counters):
+        if name.endswith('_hits'):
+            prefix = name[:-len('_hits')]
+            total = counters[name] + counters[f'{prefix}_misses']
+            lines.append(f'{prefix}_hit_ratio: {counters[name] / total:.1%}')
+    return '\n'.join(lines)
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from queries import QUERIES
+
+# Подписки на предметы и рассылка уведомлений о новых материалах.
+#
+# Загрузка материала кладёт запись в notification_queue в той же транзакции,
+# что и INSERT INTO materials. Фоновый воркер склеивает несколько загрузок
+# по одному предмету в дайджест (notification_digests) и рассылает его
+# подписчикам пачками, сохраняя курсор по user_id — после перезапуска
+# рассылка продолжается с того же места.
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        user_id INTEGER NOT NULL,
+        subject_id INTEGER NOT NULL,
+        PRIMARY KEY (subject_id, user_id),
+        FOREIGN KEY (subject_id) REFERENCES subjects(id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notification_queue (
+        id INTEGER PRIMARY KEY,
+        subject_id INTEGER NOT NULL,
+        topic_name TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notification_digests (
+        id INTEGER PRIMARY KEY,
+        subject_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        last_user_id INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_notification_queue_subject ON notification_queue (subject_id, id)',
+]
+
+# Сколько строк максимум показываем в одном дайджесте
+DIGEST_MAX_LINES = 15
+
+
+def init_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def enqueue_material(conn, topic_id, file_name):
+    """Ставит уведомление о новом материале в очередь (без commit — его делает вызывающий)"""
+    conn.execute(QUERIES['enqueue_notification'], (file_name, topic_id))
+
+
+def subscribed_subject_ids(conn, user_id):
+    rows = conn.execute(QUERIES['subscribed_subject_ids'], (user_id,)).fetchall()
+    return {r['subject_id'] for r in rows}
+
+
+def toggle_subscription(conn, user_id, subject_id):
+    """Подписывает или отписывает пользователя. Возвращает True, если теперь он подписан"""
+    cur = conn.execute(QUERIES['unsubscribe'], (user_id, subject_id))
+    if cur.rowcount == 0:
+        conn.execute(QUERIES['subscribe'], (user_id, subject_id))
+    conn.commit()
+    return cur.rowcount == 0
+
+
+def build_digest_text(subject_name, items):
+    lines = [f'• {topic}: {file_name}' for topic, file_name in items[:DIGEST_MAX_LINES]]
+    if len(items) > DIGEST_MAX_LINES:
+        lines.append(f'…и ещё {len(items) - DIGEST_MAX_LINES}')
+    return f"🔔 Новые материалы по предмету «{subject_name}»:\n" + '\n'.join(lines)
+
+
+class RateLimiter:
+    """Глобальный token bucket + минимальный интервал между сообщениями в один чат"""
+
+    def __init__(self, global_rate=25.0, per_chat_interval=1.0):
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self._tokens = global_rate
+        self._updated = time.monotonic()
+        self._last_sent = {}
+
+    async def acquire(self, chat_id):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.global_rate, self._tokens + (now - self._updated) * self.global_rate)
+            self._updated = now
+
+            chat_wait = self._last_sent.get(chat_id, 0) + self.per_chat_interval - now
+            global_wait = (1 - self._tokens) / self.global_rate
+            wait = max(chat_wait, global_wait)
+            if wait <= 0:
+                self._tokens -= 1
+                self._last_sent[chat_id] = now
+                self._prune(now)
+                return
+            await asyncio.sleep(wait)
+
+    def _prune(self, now):
+        # Не даём словарю расти вместе с числом подписчиков
+        if len(self._last_sent) > 10000:
+            deadline = now - self.per_chat_interval
+            self._last_sent = {c: t for c, t in self._last_sent.items() if t > deadline}
+
+
+class Notifier:
+    """Фоновый воркер рассылки дайджестов подписчикам"""
+
+    def __init__(self, get_connection, coalesce_delay=60, max_delay=600,
+                 batch_size=200, poll_interval=5, limiter=None):
+        self.get_connection = get_connection
+        self.coalesce_delay = coalesce_delay  # ждём «тишины» по предмету столько секунд
+        self.max_delay = max_delay  # но не дольше, чем столько с первой загрузки
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.limiter = limiter or RateLimiter()
+        self.sent_count = 0
+        self._wakeup = asyncio.Event()
+
+    def wakeup(self):
+        """Будит воркер после загрузки (сама рассылка всё равно ждёт coalesce_delay)"""
+        self._wakeup.set()
+
+    async def run(self, bot):
+        while True:
+            try:
+                await self.process_once(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в рассылке уведомлений: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_once(self, bot):
+        self.build_digests()
+        conn = self.get_connection()
+        try:
+            digests = conn.execute(QUERIES['list_digests']).fetchall()
+        finally:
+            conn.close()
+        for digest in digests:
+            await self.deliver_digest(bot, digest['id'])
+
+    def build_digests(self):
+        """Склеивает «созревшие» записи очереди в дайджесты, по одному на предмет"""
+        conn = self.get_connection()
+        try:
+            ready = conn.execute(
+                QUERIES['ready_notifications'],
+                (f'-{int(self.coalesce_delay)} seconds', f'-{int(self.max_delay)} seconds')
+            ).fetchall()
+            for row in ready:
+                items = conn.execute(
+                    QUERIES['queued_notifications'], (row['subject_id'], row['last_id'])
+                ).fetchall()
+                subject = conn.execute(QUERIES['get_subject_name'], (row['subject_id'],)).fetchone()
+                if subject and items:
+                    conn.execute(
+                        QUERIES['create_digest'],
+                        (row['subject_id'], build_digest_text(subject['name'], [tuple(i) for i in items]))
+                    )
+                conn.execute(QUERIES['dequeue_notifications'], (row['subject_id'], row['last_id']))
+                conn.commit()
+        finally:
+            conn.close()
+
+    async def deliver_digest(self, bot, digest_id):
+        conn = self.get_connection()
+        try:
+            digest = conn.execute(QUERIES['get_digest'], (digest_id,)).fetchone()
+            cursor = digest['last_user_id']
+            while True:
+                subscribers = conn.execute(
+                    QUERIES['subscribers_page'],
+                    (digest['subject_id'], cursor, self.batch_size)
+                ).fetchall()
+                if not subscribers:
+                    break
+                for sub in subscribers:
+                    await self.send(bot, conn, sub['user_id'], digest['subject_id'], digest['text'])
+                    cursor = sub['user_id']
+                # Сохраняем прогресс после каждой пачки
+                conn.execute(QUERIES['advance_digest'], (cursor, digest_id))
+                conn.commit()
+            conn.execute(QUERIES['delete_digest'], (digest_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    async def send(self, bot, conn, chat_id, subject_id, text, attempts=3):
+        for _ in range(attempts):
+            await self.limiter.acquire(chat_id)
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                self.sent_count += 1
+                return
+            except RetryAfter as e:
+                logging.warning(f"Telegram просит подождать {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+            except Forbidden:
+                # Пользователь заблокировал бота — больше ему не пишем.
+                # Коммитим сразу: иначе блокировка записи висела бы до конца пачки
+                with conn:
+                    conn.execute(QUERIES['unsubscribe_all'], (chat_id,))
+                return
+            except TelegramError as e:
+                logging.error(f"Не удалось отправить уведомление {chat_id}: {e}")
+                return
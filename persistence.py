@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from queries import PERSISTENCE_QUERIES
+
+# Хранение состояний диалогов и context.user_data в SQLite.
+#
+# Application вызывает update_* раз в update_interval секунд только для
+# изменившихся записей. Мы не пишем их сразу, а копим в памяти, отбрасываем
+# то, что не поменялось с прошлой записи, и сбрасываем всё одной транзакцией.
+# При старте загружаются только состояния диалогов, которые менялись не раньше
+# conversation_window секунд назад. Задачи conversation_timeout PTB для
+# восстановленных диалогов не создаёт, поэтому окно должно совпадать с
+# таймаутом диалога — иначе после перезапуска диалог «зависнет» навсегда.
+# Записи старше load_window удаляются с диска. user_data при старте не
+# загружается вовсе: запись пользователя читается одним запросом, когда он
+# впервые пишет боту после запуска.
+#
+# В многопроцессном режиме (workers.py) файл общий, а owns(chat_id) говорит,
+# какие чаты принадлежат этому процессу: чужие записи он не загружает, а
+# значит, никогда не перезапишет и не удалит.
+
+SCHEMA_VERSION = 2
+
+
+def init_schema(conn):
+    """Создаёт таблицу и индексы, если база ещё не этой версии"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return False
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_persistence_recent ON persistence (kind, updated_at)')
+    # Для очистки при старте: она идёт по всем kind сразу
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_persistence_updated ON persistence (updated_at)')
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    return True
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path='persistence.db', update_interval=15, flush_delay=1.0,
+                 load_window=24 * 60 * 60, conversation_window=None, owns=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self.flush_delay = flush_delay
+        self.load_window = load_window
+        self.conversation_window = load_window if conversation_window is None else conversation_window
+        self.owns = owns
+        self._conn = None
+        self._pending = {}  # (kind, key) -> json или None (удалить)
+        self._written = {}  # (kind, key) -> последний записанный json
+        self._refreshed = set()  # user_id, чьи данные уже прочитаны с диска
+        self._flush_handle = None
+        self.flush_count = 0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            init_schema(self._conn)
+            # Давно брошенные диалоги больше не нужны
+            self._conn.execute(PERSISTENCE_QUERIES['persistence_prune'], (time.time() - self.load_window,))
+            self._conn.commit()
+        return self._conn
+
+    def _load(self, kind, chat_of, window):
+        rows = self._connection().execute(
+            PERSISTENCE_QUERIES['persistence_load'], (kind, time.time() - window)
+        ).fetchall()
+        if self.owns is not None:
+            rows = [(key, data) for key, data in rows if self.owns(chat_of(key))]
+        for key, data in rows:
+            self._written[(kind, key)] = data
+        return rows
+
+    def _mark(self, kind, key, data):
+        item = (kind, key)
+        if data is None and item not in self._written:
+            self._pending.pop(item, None)  # на диске этого нет — удалять нечего
+            return
+        if data is not None and self._written.get(item) == data and item not in self._pending:
+            return  # ничего не поменялось — не пишем
+        self._pending[item] = data
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_delay, self._flush_pending)
+
+    def _flush_pending(self):
+        self._flush_handle = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        upserts = [(kind, key, data, now) for (kind, key), data in pending.items() if data is not None]
+        deletes = [(kind, key) for (kind, key), data in pending.items() if data is None]
+        conn = self._connection()
+        try:
+            with conn:
+                conn.executemany(PERSISTENCE_QUERIES['persistence_save'], upserts)
+                conn.executemany(PERSISTENCE_QUERIES['persistence_delete'], deletes)
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка при сохранении состояния диалогов: {e}")
+            # Вернём несохранённое обратно, более свежие значения не трогаем
+            for item, data in pending.items():
+                self._pending.setdefault(item, data)
+            return
+        for (kind, key), data in pending.items():
+            if data is None:
+                self._written.pop((kind, key), None)
+            else:
+                self._written[(kind, key)] = data
+        self.flush_count += 1
+
+    # --- user_data ---
+    async def get_user_data(self):
+        # Сессии читаются по одной в refresh_user_data
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        data = data.to_dict()
+        self._mark('user', str(user_id), json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None)
+
+    async def drop_user_data(self, user_id):
+        self._refreshed.discard(user_id)
+        self._mark('user', str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Application вызывает это перед каждым обработчиком; с диска читаем
+        # только первый раз — дальше сессия живёт в памяти
+        if user_id in self._refreshed:
+            return
+        self._refreshed.add(user_id)
+        item = ('user', str(user_id))
+        if item in self._pending:
+            data = self._pending[item]  # ещё не сброшено на диск
+        else:
+            row = self._connection().execute(
+                PERSISTENCE_QUERIES['persistence_load_one'], (*item, time.time() - self.load_window)
+            ).fetchone()
+            data = row[0] if row else None
+            if data is not None:
+                self._written[item] = data
+        if data is not None:
+            user_data.load(json.loads(data))
+
+    # --- Диалоги ---
+    async def get_conversations(self, name):
+        rows = self._load(f'conv:{name}', lambda key: json.loads(key)[0], self.conversation_window)
+        return {tuple(json.loads(key)): json.loads(data) for key, data in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        self._mark(f'conv:{name}', json.dumps(list(key)), None if new_state is None else json.dumps(new_state))
+
+    # --- Не храним ---
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_pending()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
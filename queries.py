@@ -0,0 +1,129 @@
+# Каталог всех SQL-запросов бота (кроме DDL схемы).
+#
+# storage.py и notifications.py берут запросы только отсюда, persistence.py —
+# из PERSISTENCE_QUERIES (у него своя база), — так query_plans.py может
+# проверить план каждого из них. Добавляя запрос, добавьте для него параметры
+# в query_plans.SAMPLE_PARAMS, а если он выполняется на каждое нажатие
+# пользователя — имя в HOT.
+
+QUERIES = {
+    # --- Преподаватели ---
+    'is_teacher': 'SELECT 1 FROM teachers WHERE user_id = ?',
+    'add_teacher': 'INSERT OR IGNORE INTO teachers (user_id) VALUES (?)',
+    'list_teachers': 'SELECT user_id FROM teachers',
+
+    # --- Предметы ---
+    'list_subjects': 'SELECT id, name FROM subjects',
+    'get_subject_id': 'SELECT id FROM subjects WHERE name = ?',
+    'create_subject': 'INSERT INTO subjects (name) VALUES (?)',
+    'get_subject_name': 'SELECT name FROM subjects WHERE id = ?',
+
+    # --- Темы ---
+    'list_topics': 'SELECT id, name FROM topics WHERE subject_id = ?',
+    'find_topic_id': 'SELECT id FROM topics WHERE subject_id = ? AND LOWER(name) = LOWER(?)',
+    'catalogue_tree': 'SELECT subject_id, id, name FROM topics ORDER BY subject_id',
+    'create_topic': 'INSERT INTO topics (subject_id, name) VALUES (?, ?)',
+    'get_topic_path': '''
+        SELECT t.name as topic_name, s.id as subject_id, s.name as subject_name
+        FROM topics t
+        JOIN subjects s ON t.subject_id = s.id
+        WHERE t.id = ?
+    ''',
+    'count_topic_materials': 'SELECT COUNT(*) FROM materials WHERE topic_id = ?',
+    'delete_topic': 'DELETE FROM topics WHERE id = ?',
+
+    # --- Материалы ---
+    'list_materials': 'SELECT id, file_name, telegram_file_id FROM materials WHERE topic_id = ?',
+    'list_subject_materials': '''
+        SELECT m.id, m.file_name, m.telegram_file_id, t.name as topic_name
+        FROM topics t
+        JOIN materials m ON m.topic_id = t.id
+        WHERE t.subject_id = ?
+    ''',
+    'add_material': 'INSERT INTO materials (topic_id, file_name, telegram_file_id, uploaded_by) VALUES (?, ?, ?, ?)',
+    'replace_material': 'UPDATE materials SET file_name = ?, telegram_file_id = ? WHERE id = ?',
+    'delete_material': 'DELETE FROM materials WHERE id = ?',
+    'search_materials': '''
+        SELECT m.id, m.file_name, m.telegram_file_id, t.name as topic_name, s.id as subject_id, s.name as subject_name
+        FROM materials m
+        JOIN topics t ON m.topic_id = t.id
+        JOIN subjects s ON t.subject_id = s.id
+        WHERE LOWER(t.name) LIKE LOWER(?) OR LOWER(s.name) LIKE LOWER(?) OR LOWER(m.file_name) LIKE LOWER(?)
+    ''',
+
+    # --- Архивы ---
+    'get_cached_archive': 'SELECT file_id FROM archive_cache WHERE scope = ? AND scope_id = ? AND version = ?',
+    'save_cached_archive': 'INSERT OR REPLACE INTO archive_cache (scope, scope_id, version, file_id) VALUES (?, ?, ?, ?)',
+
+    # --- Статистика ---
+    'record_download': 'UPDATE materials SET downloads_count = downloads_count + 1 WHERE id = ?',
+    'top_downloads': '''
+        SELECT m.file_name, m.downloads_count, t.name as topic_name, s.name as subject_name
+        FROM materials m
+        JOIN topics t ON m.topic_id = t.id
+        JOIN subjects s ON t.subject_id = s.id
+        ORDER BY m.downloads_count DESC
+        LIMIT ?
+    ''',
+
+    # --- Подписки и уведомления ---
+    'subscribed_subject_ids': 'SELECT subject_id FROM subscriptions WHERE user_id = ?',
+    'unsubscribe': 'DELETE FROM subscriptions WHERE user_id = ? AND subject_id = ?',
+    'subscribe': 'INSERT INTO subscriptions (user_id, subject_id) VALUES (?, ?)',
+    'unsubscribe_all': 'DELETE FROM subscriptions WHERE user_id = ?',
+    'subscribers_page': 'SELECT user_id FROM subscriptions WHERE subject_id = ? AND user_id > ? ORDER BY user_id LIMIT ?',
+    'enqueue_notification': '''
+        INSERT INTO notification_queue (subject_id, topic_name, file_name)
+        SELECT subject_id, name, ? FROM topics WHERE id = ?
+    ''',
+    'ready_notifications': '''
+        SELECT subject_id, MAX(id) AS last_id FROM notification_queue
+        GROUP BY subject_id
+        HAVING MAX(created_at) <= datetime('now', ?) OR MIN(created_at) <= datetime('now', ?)
+    ''',
+    'queued_notifications': 'SELECT topic_name, file_name FROM notification_queue WHERE subject_id = ? AND id <= ? ORDER BY id',
+    'dequeue_notifications': 'DELETE FROM notification_queue WHERE subject_id = ? AND id <= ?',
+    'list_digests': 'SELECT id FROM notification_digests ORDER BY id',
+    'get_digest': 'SELECT * FROM notification_digests WHERE id = ?',
+    'create_digest': 'INSERT INTO notification_digests (subject_id, text) VALUES (?, ?)',
+    'advance_digest': 'UPDATE notification_digests SET last_user_id = ? WHERE id = ?',
+    'delete_digest': 'DELETE FROM notification_digests WHERE id = ?',
+}
+
+# Запросы persistence.py к отдельной базе состояний диалогов (PERSISTENCE_DB)
+PERSISTENCE_QUERIES = {
+    'persistence_load': 'SELECT key, data FROM persistence WHERE kind = ? AND updated_at >= ?',
+    'persistence_load_one': 'SELECT data FROM persistence WHERE kind = ? AND key = ? AND updated_at >= ?',
+    'persistence_save': 'INSERT OR REPLACE INTO persistence (kind, key, data, updated_at) VALUES (?, ?, ?, ?)',
+    'persistence_delete': 'DELETE FROM persistence WHERE kind = ? AND key = ?',
+    'persistence_prune': 'DELETE FROM persistence WHERE updated_at < ?',
+}
+
+# Запросы, которые выполняются на каждое действие пользователя или при каждом
+# запуске по таблице, растущей с числом пользователей: для них полный
+# просмотр таблицы или временная сортировка недопустимы
+HOT = {
+    'is_teacher',
+    'get_subject_id',
+    'list_topics',
+    'find_topic_id',
+    'count_topic_materials',
+    'list_materials',
+    'list_subject_materials',
+    'get_cached_archive',
+    'record_download',
+    'top_downloads',
+    'subscribed_subject_ids',
+    'subscribers_page',
+    'search_materials',
+    'persistence_load',
+    'persistence_load_one',
+    'persistence_prune',
+}
+
+# Горячие запросы, полный просмотр в которых известен и пока неизбежен
+# (LIKE '%...%' не использует индекс). query_plans.py не считает их план
+# ошибкой, но проверяет число шагов VM — на строку таблицы materials.
+KNOWN_SCANS = {
+    'search_materials': 24,
+}
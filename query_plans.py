@@ -0,0 +1,217 @@
+import argparse
+import os
+import random
+import re
+import sys
+import sqlite3
+import tempfile
+import time
+
+import persistence
+from queries import HOT, KNOWN_SCANS, PERSISTENCE_QUERIES, QUERIES
+from storage import SQLiteStorage
+
+# Проверка планов всех запросов из queries.QUERIES (и PERSISTENCE_QUERIES —
+# на отдельной базе состояний) на больших синтетических базах.
+#
+#   python query_plans.py
+#
+# Для каждого запроса печатается EXPLAIN QUERY PLAN, число строк в ответе
+# и число шагов VM (≈ сколько строк SQLite пришлось просмотреть).
+# Если горячий запрос (queries.HOT) делает полный просмотр таблицы или
+# временную сортировку (USE TEMP B-TREE), скрипт завершается с кодом 1.
+# Для запросов из queries.KNOWN_SCANS такой план допустим, но число шагов VM
+# не должно превышать их бюджет.
+
+# Параметры для каждого запроса; id из синтетической базы (см. build_database)
+SAMPLE_PARAMS = {
+    'is_teacher': (500,),
+    'add_teacher': (10 ** 9,),
+    'list_teachers': (),
+    'list_subjects': (),
+    'get_subject_id': ('Предмет 7',),
+    'create_subject': ('Новый предмет',),
+    'get_subject_name': (7,),
+    'list_topics': (7,),
+    'find_topic_id': (7, 'тема 3'),
+    'catalogue_tree': (),
+    'create_topic': (7, 'Новая тема'),
+    'get_topic_path': (42,),
+    'count_topic_materials': (42,),
+    'delete_topic': (42,),
+    'list_materials': (42,),
+    'list_subject_materials': (7,),
+    'get_cached_archive': ('topic', 42, 'abc'),
+    'save_cached_archive': ('topic', 42, 'abc', 'FILE'),
+    'add_material': (42, 'new.pdf', 'FILE', 1),
+    'replace_material': ('new.pdf', 'FILE', 4242),
+    'delete_material': (4242,),
+    'search_materials': ('%Лекция 3%', '%Лекция 3%', '%Лекция 3%'),
+    'record_download': (4242,),
+    'top_downloads': (10,),
+    'subscribed_subject_ids': (500,),
+    'unsubscribe': (500, 7),
+    'subscribe': (10 ** 9, 7),
+    'unsubscribe_all': (500,),
+    'subscribers_page': (7, 0, 200),
+    'enqueue_notification': ('new.pdf', 42),
+    'ready_notifications': ('-60 seconds', '-600 seconds'),
+    'queued_notifications': (7, 10 ** 9),
+    'dequeue_notifications': (7, 10 ** 9),
+    'list_digests': (),
+    'get_digest': (1,),
+    'create_digest': (7, 'текст'),
+    'advance_digest': (100, 1),
+    'delete_digest': (1,),
+    'persistence_load': ('conv:add_material', time.time() - 600),
+    'persistence_load_one': ('user', '500', time.time() - 24 * 60 * 60),
+    'persistence_save': ('user', '500', '{"action": "add"}', time.time()),
+    'persistence_delete': ('user', '500'),
+    'persistence_prune': (time.time() - 24 * 60 * 60,),
+}
+
+
+def build_database(path, subjects=200, topics_per_subject=20, materials_per_topic=25,
+                   teachers=1000, subscribers=20000):
+    storage = SQLiteStorage(path)
+    storage.init_schema()
+    conn = storage.conn
+    rnd = random.Random(1)
+    with conn:
+        conn.executemany('INSERT INTO subjects (id, name) VALUES (?, ?)',
+                         [(s, f'Предмет {s}') for s in range(1, subjects + 1)])
+        conn.executemany(
+            'INSERT INTO topics (id, subject_id, name) VALUES (?, ?, ?)',
+            [((s - 1) * topics_per_subject + t, s, f'Тема {t}')
+             for s in range(1, subjects + 1) for t in range(1, topics_per_subject + 1)]
+        )
+        topics = subjects * topics_per_subject
+        conn.executemany(
+            'INSERT INTO materials (topic_id, file_name, telegram_file_id, uploaded_by, downloads_count) VALUES (?, ?, ?, ?, ?)',
+            [(t, f'Лекция {m}.pdf', f'FILE{t}_{m}', 1, rnd.randrange(1000))
+             for t in range(1, topics + 1) for m in range(1, materials_per_topic + 1)]
+        )
+        conn.executemany('INSERT INTO teachers (user_id) VALUES (?)', [(u,) for u in range(1, teachers + 1)])
+        conn.executemany(
+            'INSERT OR IGNORE INTO subscriptions (user_id, subject_id) VALUES (?, ?)',
+            [(u, rnd.randrange(1, subjects + 1)) for u in range(1, subscribers + 1) for _ in range(3)]
+        )
+        conn.executemany(
+            'INSERT INTO notification_queue (subject_id, topic_name, file_name) VALUES (?, ?, ?)',
+            [(rnd.randrange(1, subjects + 1), 'Тема 1', 'new.pdf') for _ in range(1000)]
+        )
+        conn.execute("INSERT INTO notification_digests (id, subject_id, text) VALUES (1, 7, 'текст')")
+    conn.execute('ANALYZE')
+    return storage
+
+
+def build_persistence_database(path, users=20000):
+    """База состояний как у persistence.SQLitePersistence: сессии и диалоги за двое суток"""
+    conn = sqlite3.connect(path)
+    persistence.init_schema(conn)
+    rnd = random.Random(1)
+    now = time.time()
+    with conn:
+        conn.executemany(
+            'INSERT INTO persistence (kind, key, data, updated_at) VALUES (?, ?, ?, ?)',
+            [('user', str(u), '{"subject_id": 7}', now - rnd.randrange(2 * 24 * 60 * 60))
+             for u in range(1, users + 1)]
+        )
+        conn.executemany(
+            'INSERT INTO persistence (kind, key, data, updated_at) VALUES (?, ?, ?, ?)',
+            [(f'conv:{name}', f'[{u}, {u}]', '1', now - rnd.randrange(2 * 24 * 60 * 60))
+             for name in ('add_material', 'replace_material', 'delete_material')
+             for u in range(1, users + 1, 4)]
+        )
+    # Без ANALYZE: persistence.py его не запускает, и планы должны быть
+    # хорошими без статистики (иначе SQLite может выручить skip-scan)
+    return conn
+
+
+def plan_problems(sql, plan):
+    """Что в плане недопустимо для горячего запроса"""
+    has_limit = re.search(r'\bLIMIT\b', sql, re.IGNORECASE) is not None
+    problems = []
+    for detail in plan:
+        if detail.startswith('SCAN ') and 'INDEX' not in detail:
+            problems.append(f'полный просмотр таблицы: {detail}')
+        elif detail.startswith('SCAN ') and not has_limit:
+            problems.append(f'полный просмотр индекса: {detail}')
+        elif 'USE TEMP B-TREE' in detail:
+            problems.append(f'временная сортировка: {detail}')
+    return problems
+
+
+def check_query(conn, name, sql, params):
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+    steps = 0
+
+    def count_step():
+        nonlocal steps
+        steps += 1
+        return 0
+
+    # Выполняем по-настоящему, но изменения откатываем
+    conn.set_progress_handler(count_step, 1)
+    try:
+        conn.execute('SAVEPOINT query_plans')
+        rows = len(conn.execute(sql, params).fetchall())
+        conn.execute('ROLLBACK TO query_plans')
+        conn.execute('RELEASE query_plans')
+    finally:
+        conn.set_progress_handler(None, 1)
+
+    problems = plan_problems(sql, plan) if name in HOT else []
+    return plan, rows, steps, problems
+
+
+def check_catalogue(conn, queries, scan_rows=0):
+    """Проверяет запросы одной базы; scan_rows — строк в materials для KNOWN_SCANS"""
+    failed = False
+    for name, sql in queries.items():
+        plan, rows, steps, problems = check_query(conn, name, sql, SAMPLE_PARAMS[name])
+        if name in KNOWN_SCANS:
+            budget = KNOWN_SCANS[name] * scan_rows
+            problems = [f'шагов VM больше бюджета {budget}'] if steps > budget else []
+        status = 'FAIL' if problems else 'ok'
+        hot = ' [hot]' if name in HOT else ''
+        known = ' [known scan]' if name in KNOWN_SCANS else ''
+        print(f'{status:4} {name}{hot}{known}: строк {rows}, шагов VM {steps}')
+        for detail in plan:
+            print(f'       {detail}')
+        for problem in problems:
+            print(f'     ! {problem}')
+        failed = failed or bool(problems)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Проверка планов SQL-запросов бота')
+    parser.add_argument('--subjects', type=int, default=200)
+    parser.add_argument('--topics', type=int, default=20, help='тем на предмет')
+    parser.add_argument('--materials', type=int, default=25, help='материалов на тему')
+    args = parser.parse_args(argv)
+
+    missing = (set(QUERIES) | set(PERSISTENCE_QUERIES)) - set(SAMPLE_PARAMS)
+    if missing:
+        print(f"Нет параметров для запросов: {', '.join(sorted(missing))}")
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = build_database(os.path.join(tmp, 'synthetic.db'), args.subjects, args.topics, args.materials)
+        conn = storage.conn
+        conn.isolation_level = None  # транзакциями управляем сами (SAVEPOINT)
+        materials = conn.execute('SELECT COUNT(*) FROM materials').fetchone()[0]
+        failed = check_catalogue(conn, QUERIES, materials)
+        storage.close()
+
+        conn = build_persistence_database(os.path.join(tmp, 'persistence.db'))
+        conn.isolation_level = None
+        failed = check_catalogue(conn, PERSISTENCE_QUERIES) or failed
+        conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
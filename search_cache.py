@@ -0,0 +1,228 @@
+import time
+from collections import OrderedDict
+
+import metrics
+from storage import sqlite_like, sqlite_lower
+
+# Кэши поверх слоя хранения: результаты поиска (LRU + TTL), а также
+# множество преподавателей и дерево каталога (предметы и темы) целиком —
+# они маленькие, читаются на каждое нажатие и меняются редко.
+#
+# Поиск:
+# Ключ — нормализованный запрос, значение — найденные строки и «поколения»
+# предметов, из которых они взяты. Любая запись в предмет увеличивает его
+# поколение, и все результаты с этим предметом перестают быть валидными.
+# Новый материал может попасть в результат, где его предмета ещё нет, —
+# такие записи находим, проверяя запрос по названиям нового материала.
+# Результаты длиннее max_rows не кэшируются — так память кэша ограничена
+# произведением max_entries на max_rows, а не размером базы.
+#
+# Инвалидация описывается событием — кортежем, который можно переслать
+# другим процессам (см. workers.Broadcast) и применить к их кэшам:
+#   ('subject', subject_id, names)   — изменился материал известного предмета
+#   ('material', material_id, names) — изменился материал, предмет ищем в кэше
+#   ('teacher', user_id, ())         — добавлен преподаватель
+#   ('catalogue', None, ())          — добавлен/удалён предмет или тема
+
+
+def normalize_query(query):
+    # LIKE в SQLite не различает регистр только у латиницы — так же нормализуем
+    return sqlite_lower(query.strip())
+
+
+class _Entry:
+    __slots__ = ('rows', 'generations', 'expires')
+
+    def __init__(self, rows, generations, expires):
+        self.rows = rows
+        self.generations = generations
+        self.expires = expires
+
+
+class SearchCache:
+    def __init__(self, max_entries=1000, ttl=300, max_rows=200):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}  # subject_id -> поколение
+
+    def get(self, query):
+        key = normalize_query(query)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires > time.monotonic() and all(
+            self._generations.get(subject_id, 0) == generation
+            for subject_id, generation in entry.generations.items()
+        ):
+            self._entries.move_to_end(key)
+            metrics.inc('search_cache_hits')
+            return entry.rows
+        if entry is not None:
+            del self._entries[key]
+        metrics.inc('search_cache_misses')
+        return None
+
+    def put(self, query, rows):
+        if len(rows) > self.max_rows:
+            metrics.inc('search_cache_skipped')
+            return
+        generations = {row['subject_id']: self._generations.get(row['subject_id'], 0) for row in rows}
+        self._entries[normalize_query(query)] = _Entry(rows, generations, time.monotonic() + self.ttl)
+        self._entries.move_to_end(normalize_query(query))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def bump(self, subject_id):
+        """Предмет изменился — результаты с ним больше не валидны"""
+        self._generations[subject_id] = self._generations.get(subject_id, 0) + 1
+
+    def evict_matching(self, *names):
+        """Удаляет результаты запросов, под которые подходит любое из названий"""
+        for key in [k for k in self._entries if any(sqlite_like(name, f'%{k}%') for name in names)]:
+            del self._entries[key]
+
+    def apply(self, event):
+        """Применяет событие инвалидации (своё или пришедшее от другого процесса)"""
+        kind, object_id, names = event
+        subject_id = object_id if kind == 'subject' else self.subject_of_material(object_id)
+        if subject_id is not None:
+            self.bump(subject_id)
+        if names:
+            self.evict_matching(*names)
+
+    def subject_of_material(self, material_id):
+        """Предмет материала, если он есть хотя бы в одном закэшированном результате"""
+        for entry in self._entries.values():
+            for row in entry.rows:
+                if row['id'] == material_id:
+                    return row['subject_id']
+        return None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachingStorage:
+    """Хранилище с кэшами; остальные методы — как есть
+
+    publish(event), если задан, получает каждое событие инвалидации —
+    так о записи узнают кэши остальных процессов.
+    """
+
+    def __init__(self, storage, cache, publish=None):
+        self.storage = storage
+        self.cache = cache
+        self.publish = publish
+        self._teachers = None
+        self._subjects = None  # список предметов; None — перечитать
+        self._topics = None  # subject_id -> список тем
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def prewarm(self):
+        """Загружает преподавателей и каталог до начала приёма обновлений"""
+        self._load_catalogue()
+        return {
+            'teachers': len(self._teachers),
+            'subjects': len(self._subjects),
+            'topics': sum(len(topics) for topics in self._topics.values()),
+        }
+
+    def _load_catalogue(self):
+        teachers, subjects, topics = self.storage.load_catalogue()
+        tree = {subject['id']: [] for subject in subjects}
+        for topic in topics:
+            tree.setdefault(topic['subject_id'], []).append(topic)
+        self._teachers = set(teachers)
+        self._subjects, self._topics = subjects, tree
+
+    def _catalogue(self):
+        if self._subjects is None:
+            self._load_catalogue()
+        return self._subjects, self._topics
+
+    # --- Преподаватели ---
+    def is_teacher(self, user_id):
+        if self._teachers is None:
+            self._load_catalogue()
+        return user_id in self._teachers
+
+    def add_teacher(self, user_id):
+        self.storage.add_teacher(user_id)
+        self._invalidate(('teacher', user_id, ()))
+
+    # --- Каталог ---
+    def list_subjects(self):
+        return self._catalogue()[0]
+
+    def get_subject_id(self, name):
+        return next((s['id'] for s in self._catalogue()[0] if s['name'] == name), None)
+
+    def get_subject_name(self, subject_id):
+        return next((s['name'] for s in self._catalogue()[0] if s['id'] == subject_id), None)
+
+    def list_topics(self, subject_id):
+        return self._catalogue()[1].get(subject_id, [])
+
+    def find_topic_id(self, subject_id, name):
+        """Как LOWER(name) = LOWER(?) в SQLite — регистр не важен только у латиницы"""
+        name = sqlite_lower(name)
+        return next((t['id'] for t in self.list_topics(subject_id) if sqlite_lower(t['name']) == name), None)
+
+    def create_subject(self, name):
+        subject_id = self.storage.create_subject(name)
+        if subject_id is not None:
+            self._invalidate(('catalogue', None, ()))
+        return subject_id
+
+    def create_topic(self, subject_id, name):
+        topic_id = self.storage.create_topic(subject_id, name)
+        self._invalidate(('catalogue', None, ()))
+        return topic_id
+
+    def delete_topic_if_empty(self, topic_id):
+        deleted = self.storage.delete_topic_if_empty(topic_id)
+        if deleted:
+            self._invalidate(('catalogue', None, ()))
+        return deleted
+
+    # --- Поиск и материалы ---
+
+    def search_materials(self, query):
+        rows = self.cache.get(query)
+        if rows is None:
+            rows = [dict(row) for row in self.storage.search_materials(query)]
+            self.cache.put(query, rows)
+        return rows
+
+    def add_material(self, topic_id, file_name, telegram_file_id, uploaded_by):
+        material_id = self.storage.add_material(topic_id, file_name, telegram_file_id, uploaded_by)
+        path = self.storage.get_topic_path(topic_id)
+        if path:
+            self._invalidate(('subject', path['subject_id'], (path['topic_name'], path['subject_name'], file_name)))
+        return material_id
+
+    def replace_material(self, material_id, file_name, telegram_file_id):
+        self.storage.replace_material(material_id, file_name, telegram_file_id)
+        self._invalidate(('material', material_id, (file_name,)))
+
+    def delete_material(self, material_id):
+        self.storage.delete_material(material_id)
+        self._invalidate(('material', material_id, ()))
+
+    def apply(self, event):
+        """Применяет событие инвалидации (своё или пришедшее от другого процесса)"""
+        kind, object_id, names = event
+        if kind == 'teacher':
+            if self._teachers is not None:
+                self._teachers.add(object_id)
+        elif kind == 'catalogue':
+            self._subjects = self._topics = None
+        else:
+            self.cache.apply(event)
+
+    def _invalidate(self, event):
+        self.apply(event)
+        if self.publish:
+            self.publish(event)
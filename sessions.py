@@ -0,0 +1,51 @@
+import time
+
+import metrics
+
+# Компактное состояние пользователя внутри диалога (context.user_data)
+# и периодическая очистка «брошенных» сессий.
+
+
+class Session:
+    """Данные пользователя между шагами диалога"""
+
+    __slots__ = ('subject_id', 'topic_id', 'action', 'old_file_id', 'temp_file_id', 'temp_file_type', 'last_seen')
+
+    # Поля, которые сохраняются в persistence (last_seen — нет, чтобы не писать на каждое сообщение)
+    FIELDS = ('subject_id', 'topic_id', 'action', 'old_file_id', 'temp_file_id', 'temp_file_type')
+
+    def __init__(self):
+        self.clear()
+        self.last_seen = time.time()
+
+    def clear(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+    def load(self, data):
+        """Заполняет сессию сохранёнными полями (обратное к to_dict)"""
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+
+    def __repr__(self):
+        return f'Session({self.to_dict()})'
+
+
+def sweep(application, idle_ttl, max_sessions):
+    """Удаляет сессии, простаивающие дольше idle_ttl, и самые старые сверх max_sessions"""
+    now = time.time()
+    sessions = sorted(application.user_data.items(), key=lambda item: item[1].last_seen)
+    evicted = 0
+    for user_id, session in sessions:
+        over_budget = len(sessions) - evicted > max_sessions
+        if not over_budget and now - session.last_seen < idle_ttl:
+            break
+        application.drop_user_data(user_id)
+        evicted += 1
+    if evicted:
+        metrics.inc('sessions_evicted', evicted)
+    metrics.counters['sessions_active'] = len(sessions) - evicted
+    return evicted
@@ -0,0 +1,405 @@
+import itertools
+import re
+import sqlite3
+
+import notifications
+from queries import QUERIES
+
+# Слой хранения: все обращения обработчиков к данным идут через эти методы.
+#
+# SQLiteStorage — рабочее хранилище (materials.db), MemoryStorage — то же
+# самое в памяти, с той же семантикой (в т.ч. LOWER()/LIKE из SQLite меняют
+# регистр только у латиницы). MemoryStorage нужен для бенчмарков и тестов,
+# где хочется мерить обработчики и Telegram без дискового I/O.
+#
+# Строки возвращаются как sqlite3.Row / dict — в обоих случаях row['поле'].
+
+# Версия схемы в PRAGMA user_version. Меняете DDL в init_schema — увеличьте её,
+# иначе на уже существующих базах изменения не применятся.
+SCHEMA_VERSION = 1
+
+
+class SQLiteStorage:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    def connect(self):
+        """Новое соединение — для фоновых задач, которым нужно своё"""
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @property
+    def conn(self):
+        # Одно соединение на весь процесс: все методы синхронные, поэтому
+        # между await'ами обработчиков транзакции не перемешиваются
+        if self._conn is None:
+            self._conn = self.connect()
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def init_schema(self):
+        """Создаёт таблицы и индексы, если версия схемы устарела. Возвращает True, если создавал"""
+        conn = self.conn
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return False
+        # auto_vacuum применяется только к новой базе; старую переводит
+        # maintenance.enable_incremental_vacuum при запуске бота
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL: чтение не блокируется записью и онлайн-бэкапом
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS subjects (
+                id INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS topics (
+                id INTEGER PRIMARY KEY,
+                subject_id INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                FOREIGN KEY (subject_id) REFERENCES subjects(id)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS materials (
+                id INTEGER PRIMARY KEY,
+                topic_id INTEGER NOT NULL,
+                file_name TEXT NOT NULL,
+                telegram_file_id TEXT NOT NULL,
+                uploaded_by INTEGER,
+                uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                downloads_count INTEGER DEFAULT 0,  -- ✅ Новое поле
+                FOREIGN KEY (topic_id) REFERENCES topics(id)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS teachers (
+                user_id INTEGER PRIMARY KEY
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS archive_cache (
+                scope TEXT NOT NULL,
+                scope_id INTEGER NOT NULL,
+                version TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                PRIMARY KEY (scope, scope_id)
+            )
+        """)
+        # Индексы под горячие запросы (см. query_plans.py)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_topics_subject ON topics (subject_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_materials_topic ON materials (topic_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_materials_downloads ON materials (downloads_count)')
+        notifications.init_schema(conn)
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+        return True
+
+    def load_catalogue(self):
+        """Преподаватели, предметы и темы — одной транзакцией чтения, согласованно"""
+        conn = self.conn
+        conn.execute('BEGIN')
+        try:
+            teachers = [row['user_id'] for row in conn.execute(QUERIES['list_teachers'])]
+            subjects = [dict(row) for row in conn.execute(QUERIES['list_subjects'])]
+            topics = [dict(row) for row in conn.execute(QUERIES['catalogue_tree'])]
+        finally:
+            conn.commit()
+        return teachers, subjects, topics
+
+    # --- Преподаватели ---
+    def is_teacher(self, user_id):
+        return self.conn.execute(QUERIES['is_teacher'], (user_id,)).fetchone() is not None
+
+    def add_teacher(self, user_id):
+        with self.conn:
+            self.conn.execute(QUERIES['add_teacher'], (user_id,))
+
+    # --- Предметы ---
+    def list_subjects(self):
+        return self.conn.execute(QUERIES['list_subjects']).fetchall()
+
+    def get_subject_id(self, name):
+        row = self.conn.execute(QUERIES['get_subject_id'], (name,)).fetchone()
+        return row['id'] if row else None
+
+    def get_subject_name(self, subject_id):
+        row = self.conn.execute(QUERIES['get_subject_name'], (subject_id,)).fetchone()
+        return row['name'] if row else None
+
+    def create_subject(self, name):
+        """Возвращает id нового предмета или None, если такой уже есть"""
+        try:
+            with self.conn:
+                return self.conn.execute(QUERIES['create_subject'], (name,)).lastrowid
+        except sqlite3.IntegrityError:
+            return None
+
+    # --- Темы ---
+    def list_topics(self, subject_id):
+        return self.conn.execute(QUERIES['list_topics'], (subject_id,)).fetchall()
+
+    def find_topic_id(self, subject_id, name):
+        """Поиск темы без учёта регистра (как LOWER() в SQLite — только латиница)"""
+        row = self.conn.execute(QUERIES['find_topic_id'], (subject_id, name)).fetchone()
+        return row['id'] if row else None
+
+    def create_topic(self, subject_id, name):
+        with self.conn:
+            return self.conn.execute(QUERIES['create_topic'], (subject_id, name)).lastrowid
+
+    def get_topic_path(self, topic_id):
+        """Название темы и предмет, к которому она относится"""
+        return self.conn.execute(QUERIES['get_topic_path'], (topic_id,)).fetchone()
+
+    def delete_topic_if_empty(self, topic_id):
+        """Удаляет тему без материалов. Возвращает True, если тема удалена"""
+        with self.conn:
+            remaining = self.conn.execute(QUERIES['count_topic_materials'], (topic_id,)).fetchone()[0]
+            if remaining:
+                return False
+            self.conn.execute(QUERIES['delete_topic'], (topic_id,))
+            return True
+
+    # --- Материалы ---
+    def list_materials(self, topic_id):
+        return self.conn.execute(QUERIES['list_materials'], (topic_id,)).fetchall()
+
+    def list_subject_materials(self, subject_id):
+        """Все материалы предмета с названиями тем"""
+        return self.conn.execute(QUERIES['list_subject_materials'], (subject_id,)).fetchall()
+
+    def add_material(self, topic_id, file_name, telegram_file_id, uploaded_by):
+        """Сохраняет материал и в той же транзакции ставит уведомление подписчикам"""
+        with self.conn:
+            material_id = self.conn.execute(
+                QUERIES['add_material'],
+                (topic_id, file_name, telegram_file_id, uploaded_by)
+            ).lastrowid
+            notifications.enqueue_material(self.conn, topic_id, file_name)
+        return material_id
+
+    def replace_material(self, material_id, file_name, telegram_file_id):
+        with self.conn:
+            self.conn.execute(QUERIES['replace_material'], (file_name, telegram_file_id, material_id))
+
+    def delete_material(self, material_id):
+        with self.conn:
+            self.conn.execute(QUERIES['delete_material'], (material_id,))
+
+    def search_materials(self, query):
+        pattern = f'%{query}%'
+        return self.conn.execute(QUERIES['search_materials'], (pattern, pattern, pattern)).fetchall()
+
+    # --- Архивы ---
+    def get_cached_archive(self, scope, scope_id, version):
+        """file_id уже отправленного архива темы/предмета, если содержимое с тех пор не менялось"""
+        row = self.conn.execute(QUERIES['get_cached_archive'], (scope, scope_id, version)).fetchone()
+        return row['file_id'] if row else None
+
+    def save_cached_archive(self, scope, scope_id, version, file_id):
+        with self.conn:
+            self.conn.execute(QUERIES['save_cached_archive'], (scope, scope_id, version, file_id))
+
+    # --- Статистика ---
+    def record_downloads(self, material_ids):
+        """Увеличивает счётчики скачиваний одной транзакцией"""
+        with self.conn:
+            self.conn.executemany(
+                QUERIES['record_download'],
+                [(material_id,) for material_id in material_ids]
+            )
+
+    def top_downloads(self, limit=10):
+        return self.conn.execute(QUERIES['top_downloads'], (limit,)).fetchall()
+
+    # --- Подписки ---
+    def subscribed_subject_ids(self, user_id):
+        return notifications.subscribed_subject_ids(self.conn, user_id)
+
+    def toggle_subscription(self, user_id, subject_id):
+        return notifications.toggle_subscription(self.conn, user_id, subject_id)
+
+
+def sqlite_lower(text):
+    # LOWER() в SQLite без ICU меняет регистр только у ASCII
+    return ''.join(c.lower() if c.isascii() else c for c in text)
+
+
+def sqlite_like(value, pattern):
+    # LIKE в SQLite: % — любая строка, _ — один символ, регистр не важен только для ASCII
+    regex = ''.join('.*' if c == '%' else '.' if c == '_' else re.escape(c) for c in sqlite_lower(pattern))
+    return re.fullmatch(regex, sqlite_lower(value), re.DOTALL) is not None
+
+
+class MemoryStorage:
+    """Хранилище в памяти с той же семантикой, что и SQLiteStorage"""
+
+    def __init__(self):
+        self.init_schema()
+
+    def init_schema(self):
+        if hasattr(self, 'subjects'):
+            return
+        self.teachers = set()
+        self.subjects = {}  # id -> {'id', 'name'}
+        self.topics = {}  # id -> {'id', 'subject_id', 'name'}
+        self.materials = {}  # id -> {'id', 'topic_id', 'file_name', ...}
+        self.subscriptions = set()  # (user_id, subject_id)
+        self.archive_cache = {}  # (scope, scope_id) -> (version, file_id)
+        self._ids = {table: itertools.count(1) for table in ('subjects', 'topics', 'materials')}
+
+    def close(self):
+        pass
+
+    def load_catalogue(self):
+        topics = sorted(self.topics.values(), key=lambda t: (t['subject_id'], t['id']))
+        return list(self.teachers), self.list_subjects(), [dict(t) for t in topics]
+
+    # --- Преподаватели ---
+    def is_teacher(self, user_id):
+        return user_id in self.teachers
+
+    def add_teacher(self, user_id):
+        self.teachers.add(user_id)
+
+    # --- Предметы ---
+    def list_subjects(self):
+        return [dict(s) for s in self.subjects.values()]
+
+    def get_subject_id(self, name):
+        return next((s['id'] for s in self.subjects.values() if s['name'] == name), None)
+
+    def get_subject_name(self, subject_id):
+        subject = self.subjects.get(subject_id)
+        return subject['name'] if subject else None
+
+    def create_subject(self, name):
+        if self.get_subject_id(name) is not None:
+            return None
+        subject_id = next(self._ids['subjects'])
+        self.subjects[subject_id] = {'id': subject_id, 'name': name}
+        return subject_id
+
+    # --- Темы ---
+    def list_topics(self, subject_id):
+        return [{'id': t['id'], 'name': t['name']} for t in self.topics.values() if t['subject_id'] == subject_id]
+
+    def find_topic_id(self, subject_id, name):
+        name = sqlite_lower(name)
+        return next(
+            (t['id'] for t in self.topics.values()
+             if t['subject_id'] == subject_id and sqlite_lower(t['name']) == name),
+            None
+        )
+
+    def create_topic(self, subject_id, name):
+        topic_id = next(self._ids['topics'])
+        self.topics[topic_id] = {'id': topic_id, 'subject_id': subject_id, 'name': name}
+        return topic_id
+
+    def get_topic_path(self, topic_id):
+        topic = self.topics.get(topic_id)
+        subject = topic and self.subjects.get(topic['subject_id'])
+        if not subject:
+            return None
+        return {'topic_name': topic['name'], 'subject_id': subject['id'], 'subject_name': subject['name']}
+
+    def delete_topic_if_empty(self, topic_id):
+        if any(m['topic_id'] == topic_id for m in self.materials.values()):
+            return False
+        self.topics.pop(topic_id, None)
+        return True
+
+    # --- Материалы ---
+    def list_materials(self, topic_id):
+        return [
+            {'id': m['id'], 'file_name': m['file_name'], 'telegram_file_id': m['telegram_file_id']}
+            for m in self.materials.values() if m['topic_id'] == topic_id
+        ]
+
+    def list_subject_materials(self, subject_id):
+        return [
+            {'id': m['id'], 'file_name': m['file_name'], 'telegram_file_id': m['telegram_file_id'],
+             'topic_name': t['name']}
+            for m, t, s in self._joined() if s['id'] == subject_id
+        ]
+
+    def add_material(self, topic_id, file_name, telegram_file_id, uploaded_by):
+        material_id = next(self._ids['materials'])
+        self.materials[material_id] = {
+            'id': material_id, 'topic_id': topic_id, 'file_name': file_name,
+            'telegram_file_id': telegram_file_id, 'uploaded_by': uploaded_by, 'downloads_count': 0
+        }
+        # Очередь уведомлений не ведём: рассылка работает только поверх SQLite
+        return material_id
+
+    def replace_material(self, material_id, file_name, telegram_file_id):
+        if material_id in self.materials:
+            self.materials[material_id].update(file_name=file_name, telegram_file_id=telegram_file_id)
+
+    def delete_material(self, material_id):
+        self.materials.pop(material_id, None)
+
+    def _joined(self):
+        for m in self.materials.values():
+            topic = self.topics.get(m['topic_id'])
+            subject = topic and self.subjects.get(topic['subject_id'])
+            if subject:
+                yield m, topic, subject
+
+    def search_materials(self, query):
+        pattern = f'%{query}%'
+        return [
+            {'id': m['id'], 'file_name': m['file_name'], 'telegram_file_id': m['telegram_file_id'],
+             'topic_name': t['name'], 'subject_id': s['id'], 'subject_name': s['name']}
+            for m, t, s in self._joined()
+            if sqlite_like(t['name'], pattern) or sqlite_like(s['name'], pattern) or sqlite_like(m['file_name'], pattern)
+        ]
+
+    # --- Архивы ---
+    def get_cached_archive(self, scope, scope_id, version):
+        cached = self.archive_cache.get((scope, scope_id))
+        return cached[1] if cached and cached[0] == version else None
+
+    def save_cached_archive(self, scope, scope_id, version, file_id):
+        self.archive_cache[(scope, scope_id)] = (version, file_id)
+
+    # --- Статистика ---
+    def record_downloads(self, material_ids):
+        for material_id in material_ids:
+            if material_id in self.materials:
+                self.materials[material_id]['downloads_count'] += 1
+
+    def top_downloads(self, limit=10):
+        rows = [
+            {'file_name': m['file_name'], 'downloads_count': m['downloads_count'],
+             'topic_name': t['name'], 'subject_name': s['name']}
+            for m, t, s in self._joined()
+        ]
+        return sorted(rows, key=lambda r: r['downloads_count'], reverse=True)[:limit]
+
+    # --- Подписки ---
+    def subscribed_subject_ids(self, user_id):
+        return {subject_id for uid, subject_id in self.subscriptions if uid == user_id}
+
+    def toggle_subscription(self, user_id, subject_id):
+        key = (user_id, subject_id)
+        if key in self.subscriptions:
+            self.subscriptions.discard(key)
+            return False
+        self.subscriptions.add(key)
+        return True
+
+
+def create_storage(backend, path):
+    if backend == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(path)
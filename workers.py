@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+
+import httpx
+from telegram import Update
+
+# Многопроцессный режим: WORKERS > 1.
+#
+# Главный процесс (ingress) сам забирает обновления через getUpdates, не
+# разбирая их в объекты, и раздаёт по chat_id процессам-обработчикам:
+# чат всегда попадает в один и тот же процесс, а тот обрабатывает свои
+# обновления строго по очереди — состояния ConversationHandler остаются
+# корректными. Каждый обработчик — обычное Application без Updater.
+#
+# Кэши у процессов свои. Об изменениях они сообщают друг другу через
+# Broadcast: событие кладётся во входящие очереди всех остальных процессов.
+#
+# Для проверки на одной машине TELEGRAM_API_URL можно направить на
+# локальную заглушку Bot API.
+
+POLL_TIMEOUT = 30
+RETRY_DELAY = 3
+
+
+def partition(chat_id, count):
+    """Номер процесса, который обслуживает чат"""
+    return chat_id % count
+
+
+def chat_id_of(update):
+    """chat_id из «сырого» обновления (dict из JSON), без разбора в объекты PTB"""
+    for key, payload in update.items():
+        if key == 'update_id' or not isinstance(payload, dict):
+            continue
+        if 'chat' in payload:
+            return payload['chat']['id']
+        if 'chat' in payload.get('message', {}):
+            return payload['message']['chat']['id']  # callback_query
+        for user_key in ('from', 'user'):
+            if user_key in payload:
+                return payload[user_key]['id']
+    return 0  # например, poll — без чата; все такие идут в нулевой процесс
+
+
+class Broadcast:
+    """Рассылка событий между процессами: у каждого своя входящая очередь"""
+
+    def __init__(self, index, queues):
+        self.index = index
+        self.queues = queues
+
+    def publish(self, event):
+        for i, queue in enumerate(self.queues):
+            if i != self.index:
+                queue.put(event)
+
+    @property
+    def inbox(self):
+        return self.queues[self.index]
+
+
+def _pump(queue, handle):
+    # Блокирующее чтение очереди в отдельном потоке; None — сигнал остановки
+    while True:
+        item = queue.get()
+        handle(item)
+        if item is None:
+            return
+
+
+def serve(application, updates, broadcast, on_event):
+    """Запускает обработчик: обновления из updates, события Broadcast — в on_event"""
+    asyncio.run(_serve(application, updates, broadcast, on_event))
+
+
+async def _serve(application, updates, broadcast, on_event):
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    def handle_update(raw):
+        if raw is None:
+            loop.call_soon_threadsafe(stopped.set)
+            return
+        # Разбор JSON тоже делаем в потоке, а не в цикле событий
+        update = Update.de_json(json.loads(raw), application.bot)
+        loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+
+    def handle_event(event):
+        if event is not None:
+            loop.call_soon_threadsafe(on_event, event)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        threading.Thread(target=_pump, args=(updates, handle_update), daemon=True).start()
+        threading.Thread(target=_pump, args=(broadcast.inbox, handle_event), daemon=True).start()
+        await stopped.wait()
+        # stop() дообрабатывает всё, что уже лежит в update_queue
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def _worker_entry(target, index, count, updates, queues):
+    # Ctrl+C получает вся группа процессов; останавливает обработчиков ingress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.info(f"Обработчик {index}/{count} запущен")
+    target(index, count, updates[index], Broadcast(index, queues))
+
+
+def run(count, target, token, api_url='https://api.telegram.org'):
+    """Запускает count обработчиков target(index, count, updates, broadcast) и ingress"""
+    # spawn: у каждого процесса свои соединения с БД и свои кэши
+    ctx = multiprocessing.get_context('spawn')
+    updates = [ctx.Queue() for _ in range(count)]
+    queues = [ctx.Queue() for _ in range(count)]
+    processes = [
+        ctx.Process(target=_worker_entry, args=(target, i, count, updates, queues), name=f'worker-{i}')
+        for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(_ingress(token, api_url, updates, processes))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for queue in updates + queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+
+
+async def _ingress(token, api_url, updates, processes):
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    stop = asyncio.ensure_future(stopped.wait())
+
+    url = f'{api_url}/bot{token}'
+    offset = 0
+    async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+        await client.post(f'{url}/deleteWebhook')
+        while True:
+            dead = [p.name for p in processes if not p.is_alive()]
+            if dead:
+                logging.error(f"Обработчики завершились: {', '.join(dead)}; останавливаемся")
+                break
+            poll = asyncio.ensure_future(client.post(
+                f'{url}/getUpdates', json={'offset': offset, 'timeout': POLL_TIMEOUT}
+            ))
+            await asyncio.wait([poll, stop], return_when=asyncio.FIRST_COMPLETED)
+            if stop.done():
+                poll.cancel()
+                break
+            try:
+                response = poll.result()
+                response.raise_for_status()
+                result = response.json()['result']
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                logging.error(f"Ошибка при получении обновлений: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            for update in result:
+                index = partition(chat_id_of(update), len(updates))
+                updates[index].put(json.dumps(update))
+                offset = update['update_id'] + 1
+    stop.cancel()